@@ -1,4 +1,3 @@
-import subprocess
 import time
 import os
 import datetime
@@ -6,9 +5,15 @@ import sys
 import threading
 import keyboard
 import cv2
-import numpy as np
-from functools import lru_cache
 import requests
+import adb_capture
+import adb_client
+import adb_device
+import adb_input
+import matcher
+import template_store
+import waits
+import workflow
 
 """
     雷電模擬器:平板版(1280*720)
@@ -19,14 +24,13 @@ keep_running = True  # 控制程序運行狀態
 
 def setup_adb():
     """
-    設置 ADB 連接
+    設置 ADB 連接，已建立的連接直接沿用 (命令失敗後才會重新連線)
     """
-    # 啟動 ADB 服務器
-    subprocess.run("adb start-server", shell=True)
-    
-    # 獲取已連接設備列表
-    devices = run_adb_command("devices")
-    if "device" not in devices:
+    if adb_client.is_connected():
+        return
+
+    # 啟動 ADB 服務器並確認設備已連接
+    if adb_client.connect() is None:
         print("未檢測到已連接的設備，請確保模擬器已啟動並已連接。")
         sys.exit(1)
     
@@ -37,132 +41,156 @@ def stop_program():
     keep_running = False
     print("\n檢測到鍵盤輸入，程序將停止運行。")
 
+def is_running():
+    """
+    全域 keep_running 與目前裝置工作 (多裝置執行時) 都未停止
+    """
+    return keep_running and adb_device.worker_running()
+
 def stop_program_on_keypress():
     keyboard.add_hotkey('`', stop_program)
     print("已設置按下 'esc' 鍵以停止程序。")
 
-def run_adb_command(command):
+def run_adb_command(command, serial=None):
     """
     執行ADB命令
     """
-    full_command = f"adb {command}"
-    result = subprocess.run(full_command, shell=True, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"ADB命令執行失敗: {full_command}")
-        print(f"錯誤信息: {result.stderr}")
-    return result.stdout.strip()
-
-def tap(x, y):
+    return adb_client.run_adb_command(command, serial)
+
+def tap(x, y, serial=None):
     """
     在指定坐標點擊
     """
-    run_adb_command(f"shell input tap {x} {y}")
+    adb_input.tap(x, y, serial)
+    adb_capture.invalidate_frames(serial)
     print(f"點擊坐標: ({x}, {y})")
 
-def swipe(x1, y1, x2, y2, duration=500):
+def swipe(x1, y1, x2, y2, duration=500, serial=None):
     """
     從一個坐標滑動到另一個坐標
     """
-    run_adb_command(f"shell input swipe {x1} {y1} {x2} {y2} {duration}")
+    adb_input.swipe(x1, y1, x2, y2, duration, serial)
+    adb_capture.invalidate_frames(serial)
     print(f"滑動: 從 ({x1}, {y1}) 到 ({x2}, {y2})")
 
 def check_image(image_path, region=None):
     try:
-        # 檢查文件是否存在
-        if not os.path.isfile(image_path):
+        # 從模板圖庫讀取模板圖像 (不存在時為 None)
+        template = template_store.load_image(image_path)
+        if template is None:
             print(f"文件不存在: {image_path}")
             return False, None, None
 
-        # 使用 ADB 命令捕獲屏幕並直接讀取到內存
-        result = subprocess.run("adb exec-out screencap -p", shell=True, capture_output=True)
-        if result.returncode != 0:
-            print(f"ADB screencap 命令失敗: {result.stderr.decode('utf-8')}")
-            return False, None, None
-
-        # 將捕獲的圖像數據轉換為 numpy 數組
-        screen_np = np.frombuffer(result.stdout, np.uint8)
-        screen = cv2.imdecode(screen_np, cv2.IMREAD_COLOR)
+        # 從擷取後端取得目前螢幕畫面
+        screen = capture_screen()
         if screen is None:
-            print("無法解碼 ADB 截圖")
+            print("無法擷取 ADB 截圖")
             return False, None, None
 
         # 如果指定了範圍，裁剪屏幕圖像
         if region:
             x, y, w, h = region
-            screen = screen[y:y+h, x:x+w]
-            cv2.imwrite("./photo/sample.png", screen)
-        # 讀取模板圖像
-        template = cv2.imread(image_path)
-        if template is None:
-            print(f"無法讀取模板圖像: {image_path}")
-            return False, None, None
-        
-        # 使用 OpenCV 進行模板匹配
-        result = cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED)
-        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-        
-        if max_val >= 0.8:
-            if region:
-                max_loc = (max_loc[0] + x, max_loc[1] + y)
-            return True, max_loc, template.shape
+            cv2.imwrite("./photo/sample.png", screen[y:y+h, x:x+w])
+        # 模板匹配 (金字塔模式: 先縮小比對，再以全解析度精修)
+        match = matcher.match_path(screen, image_path, region)
+        if match.found:
+            return True, match.location, match.shape
         else:
             return False, None, None
     except Exception as e:
         print(f"圖像處理過程中發生錯誤: {str(e)}")
         return False, None, None
 
-def find_and_click_image(image_path, max_attempts=100, delay=0.1, region=None):
+def find_and_click_image(image_path, max_attempts=100, delay=0.1, region=None, timeout=None):
     """
-    找到屏幕上的圖像並點擊，如果失敗則重試
+    找到屏幕上的圖像並點擊
+    畫面有變化時才重新比對，逾時 (預設為舊版 max_attempts 次嘗試約需的秒數) 後放棄
     """
-    for attempt in range(max_attempts):
-        if not keep_running:
-            print("程序停止中...")
-            return False
+    if not is_running():
+        print("程序停止中...")
+        return False
 
-        found, location, shape = check_image(image_path, region)
-        if found:
-            center_x = location[0] + shape[1] // 2
-            center_y = location[1] + shape[0] // 2
-            tap(center_x, center_y)
-            print(f"找到並點擊了圖像: {image_path} at {center_x}, {center_y}")
-            time.sleep(delay)
-            return True
-        else:
-            print(f"未找到圖像，嘗試 {attempt + 1}/{max_attempts}，將重試...")
-            time.sleep(delay)
-    
-    print(f"在 {max_attempts} 次嘗試後仍未找到匹配的圖像: {image_path}")
+    timeout = timeout or waits.attempts_timeout(max_attempts, delay)
+    match = waits.wait_for_image(image_path, region, timeout=timeout, should_continue=is_running)
+    if match.found:
+        center_x, center_y = matcher.center_of(match)
+        tap(center_x, center_y)
+        print(f"找到並點擊了圖像: {image_path} at {center_x}, {center_y}")
+        adb_input.sleep(delay)
+        return True
+
+    if not is_running():
+        print("程序停止中...")
+        return False
+    print(f"在 {timeout} 秒內仍未找到匹配的圖像: {image_path}")
     return False
 
 
 def click_images_in_sequence(image_paths, max_attempts=50, delay=0.5, region=None):
     """
     依序點擊多張圖片
+    每次擷取以同一幀比對所有尚未點擊的圖片: 後面的圖片已出現時略過前面已通過的步驟，同時可見的連續步驟一次點完
     """
-    for i, image_path in enumerate(image_paths, 1):
-        if not keep_running:
+    pending = []
+    for image_path in image_paths:
+        if not os.path.isfile(image_path):
+            print(f"文件不存在: {image_path}")
+            continue
+        pending.append(image_path)
+
+    step = 0
+    attempt = 0
+    while step < len(pending):
+        if not is_running():
             print("程序停止中...")
             return False
 
-        if not os.path.isfile(image_path):
-            print(f"文件不存在: {image_path}")
+        screen = capture_screen()
+        matches = matcher.match_all(screen, pending[step:], region) if screen is not None else []
+        clicks = matcher.visible_run(matches)
+        if not clicks:
+            attempt += 1
+            if attempt < max_attempts:
+                print(f"未找到第 {step + 1} 張圖片，嘗試 {attempt}/{max_attempts}，將重試...")
+                time.sleep(delay)
+                continue
+            print(f"無法點擊第 {step + 1} 張圖片: {pending[step]}，繼續下一張")
+            step += 1
+            attempt = 0
             continue
-        
-        print(f"正在嘗試點擊第 {i} 張圖片: {image_path}")
-        if find_and_click_image(image_path, max_attempts=max_attempts, delay=delay, region=region):
-            print(f"成功點擊第 {i} 張圖片: {image_path}")
-        else:
-            print(f"無法點擊第 {i} 張圖片: {image_path}，繼續下一張")
-        time.sleep(delay)
+
+        if clicks[0] > 0:
+            print(f"後面的圖片已出現，略過已通過的 {clicks[0]} 張圖片 (從第 {step + 1} 張起)")
+        for index in clicks:
+            center_x, center_y = matcher.center_of(matches[index])
+            tap(center_x, center_y)
+            print(f"成功點擊第 {step + index + 1} 張圖片: {pending[step + index]} at {center_x}, {center_y}")
+            adb_input.sleep(delay * 2)
+        step += clicks[-1] + 1
+        attempt = 0
     return True
 
 def click_until_next_image(click_coords, next_image_path, max_attempts=50, delay=2, region=None):
     """
     持續點擊指定坐標，直到能夠檢測到下一張圖片
+    waits.PIPELINED_CLICK 開啟時點擊與擷取/比對同時進行，偵測到圖片後立即停止點擊
     """
+    if waits.PIPELINED_CLICK:
+        if not is_running():
+            print("程序停止中...")
+            return False
+        result = waits.tap_until_image(click_coords, next_image_path, region, timeout=max_attempts * delay,
+                                       tap_interval=delay, should_continue=is_running)
+        if result.found:
+            print(f"檢測到下一張圖片: {next_image_path} (耗時 {result.elapsed:.2f} 秒，點擊 {result.taps} 次)")
+        else:
+            print(f"在 {result.elapsed:.0f} 秒內仍未檢測到下一張圖片。(點擊 {result.taps} 次)")
+        return result.found
+
+    start = time.monotonic()
+    skipped = matcher.skipped_matches(next_image_path)
     for attempt in range(max_attempts):
-        if not keep_running:
+        if not is_running():
             print("程序停止中...")
             return False
 
@@ -171,24 +199,19 @@ def click_until_next_image(click_coords, next_image_path, max_attempts=50, delay
         
         found, _, _= check_image(next_image_path, region)
         if found:
-            print(f"檢測到下一張圖片: {next_image_path}")
+            print(f"檢測到下一張圖片: {next_image_path} (耗時 {time.monotonic() - start:.2f} 秒，快速檢查略過 {matcher.skipped_matches(next_image_path) - skipped} 次比對)")
             return True
         
         time.sleep(delay)
     
-    print(f"在 {max_attempts} 次嘗試後仍未檢測到下一張圖片。")
+    print(f"在 {max_attempts} 次嘗試後仍未檢測到下一張圖片。(快速檢查略過 {matcher.skipped_matches(next_image_path) - skipped} 次比對)")
     return False
 
-def capture_screen():
-    result = subprocess.run("adb exec-out screencap -p", shell=True, capture_output=True)
-    screen_np = np.frombuffer(result.stdout, np.uint8)
-    return cv2.imdecode(screen_np, cv2.IMREAD_COLOR)
+def capture_screen(serial=None):
+    return adb_capture.capture_screen(serial)
 
 def check_image_in_screen(screen, image_path):
-    template = cv2.imread(image_path)
-    result = cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED)
-    _, max_val, _, _ = cv2.minMaxLoc(result)
-    return max_val >= 0.8
+    return matcher.match_path(screen, image_path).found
 def click_and_print_coordinates():
     """
     捕獲螢幕並打印點擊位置的座標
@@ -218,6 +241,15 @@ def click_and_print_coordinates():
     
     cv2.destroyAllWindows()
 
+def farming_loop():
+    """
+    周回流程 (flows/ld_farming.json)，持續執行直到 keep_running 或所屬裝置工作被停止
+    多裝置執行時每台裝置各自在自己的線程中執行一次本函數
+    每一輪開始前先確認 adb 連線 (命令失敗後在此重新連線，沒有設備時結束)，
+    再辨識目前畫面，中斷或彈出視窗後可直接從對應步驟繼續
+    """
+    workflow.run_flow("ld_farming", should_continue=is_running, log=print, before_iteration=setup_adb)
+
 # 主程序
 def main():
     
@@ -231,33 +263,7 @@ def main():
     
     # click_and_print_coordinates()
 
-    # 定義圖片的路徑
-    login = [f"./photo/{i}.png" for i in range(1, 6)]
-    login1 = [f"./photo/{i}.png" for i in range(7, 13)]
-    
-    update = login = [f"./photo/{i}.png" for i in range(1, 3)]
-    update1 = login = [f"./photo/{i}.png" for i in range(3, 6)]
-    
-    while keep_running:
-        setup_adb()
-        if click_images_in_sequence(update):
-            tap(961, 257)
-            tee, _, _= check_image("./photo/teeth.png", (776, 111, 148, 165))
-            if tee:
-                print("找到了")
-                swipe(841, 166, 420, 251)
-            else:
-                print("沒找到")
-                click_until_next_image((1146, 52), "./photo/teeth.png", region=(776, 111, 148, 165))
-                swipe(841, 166, 420, 251)
-            time.sleep(1)
-            tap(92, 50)
-            time.sleep(1)
-            if click_images_in_sequence(update1):
-                if click_until_next_image((704, 350), "./photo/monster.png"):
-                    if find_and_click_image("./photo/monster.png"):
-                        if click_until_next_image((704, 350), "./photo/boss.png"):
-                            click_images_in_sequence(login1) 
+    farming_loop()
           
     print(f"--- 程序執行結束 {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
     sys.stdout.close()
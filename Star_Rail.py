@@ -1,4 +1,3 @@
-import subprocess
 import time
 import os
 import datetime
@@ -6,10 +5,15 @@ import sys
 import threading
 import keyboard
 import cv2
-import numpy as np
-from functools import lru_cache
 import logging
-import pytesseract
+import adb_capture
+import adb_client
+import adb_input
+import digit_ocr
+import latency
+import matcher
+import template_store
+import waits
 
 """
     雷電模擬器:平板版(1280*720)
@@ -22,14 +26,14 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 
 def setup_adb():
     """
-    設置 ADB 連接
+    設置 ADB 連接，已建立的連接直接沿用 (命令失敗後才會重新連線)
     """
+    if adb_client.is_connected():
+        return
+
     logging.info("啟動 ADB 服務器")
-    subprocess.run("adb start-server", shell=True)
-    
-    # 獲取已連接設備列表
-    devices = run_adb_command("devices")
-    if "device" not in devices:
+    # 確認設備已連接
+    if adb_client.connect() is None:
         logging.error("未檢測到已連接的設備，請確保模擬器已啟動並已連接。")
         sys.exit(1)
     
@@ -48,12 +52,8 @@ def run_adb_command(command):
     """
     執行ADB命令
     """
-    full_command = f"adb {command}"
     try:
-        result = subprocess.run(full_command, shell=True, capture_output=True, text=True)
-        if result.returncode != 0:
-            logging.error(f"ADB命令執行失敗: {full_command}，錯誤信息: {result.stderr}")
-        return result.stdout.strip()
+        return adb_client.run_adb_command(command)
     except Exception as e:
         logging.error(f"執行ADB命令出錯: {str(e)}")
         return None
@@ -62,31 +62,27 @@ def tap(x, y):
     """
     在指定坐標點擊
     """
-    run_adb_command(f"shell input tap {x} {y}")
+    adb_input.tap(x, y)
+    adb_capture.invalidate_frames()
     logging.info(f"點擊坐標: ({x}, {y})")
 
 def swipe(x1, y1, x2, y2, duration=500):
     """
     從一個坐標滑動到另一個坐標
     """
-    run_adb_command(f"shell input swipe {x1} {y1} {x2} {y2} {duration}")
+    adb_input.swipe(x1, y1, x2, y2, duration)
+    adb_capture.invalidate_frames()
     logging.info(f"滑動: 從 ({x1}, {y1}) 到 ({x2}, {y2})")
 
-@lru_cache(maxsize=10)
 def load_image(image_path):
     """
-    讀取並快取模板圖像
+    從模板圖庫讀取模板圖像 (所有模板在第一次使用時一併載入，並以磁碟快取加速)
     """
-    if not os.path.isfile(image_path):
-        logging.error(f"文件不存在: {image_path}")
-        return None
-    return cv2.imread(image_path)
+    return template_store.load_image(image_path)
 
 def capture_screen():
     try:
-        result = subprocess.run("adb exec-out screencap -p", shell=True, capture_output=True)
-        screen_np = np.frombuffer(result.stdout, np.uint8)
-        return cv2.imdecode(screen_np, cv2.IMREAD_COLOR)
+        return adb_capture.capture_screen()
     except Exception as e:
         logging.error(f"無法捕獲螢幕畫面: {str(e)}")
         return None
@@ -101,75 +97,102 @@ def check_image(image_path, region=None):
             logging.error("無法捕獲螢幕畫面")
             return False, None, None
 
-        if region:
-            x, y, w, h = region
-            screen = screen[y:y + h, x:x + w]
-
-        template = load_image(image_path)
-        if template is None:
-            return False, None, None
-
-        result = cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED)
-        _, max_val, _, max_loc = cv2.minMaxLoc(result)
-        
-        if max_val >= 0.8:
-            if region:
-                max_loc = (max_loc[0] + x, max_loc[1] + y)
-            return True, max_loc, template.shape
+        # 模板匹配 (金字塔模式: 先縮小比對，再以全解析度精修)
+        match = matcher.match_path(screen, image_path, region)
+        if match.found:
+            return True, match.location, match.shape
         return False, None, None
     except Exception as e:
         logging.error(f"圖像處理過程中發生錯誤: {str(e)}")
         return False, None, None
 
-def find_and_click_image(image_path, max_attempts=100, delay=0.1, region=None):
+def find_and_click_image(image_path, max_attempts=100, delay=0.1, region=None, timeout=None):
     """
     找到屏幕上的圖像並點擊
+    畫面有變化時才重新比對，逾時 (預設為舊版 max_attempts 次嘗試約需的秒數) 後放棄
     """
-    for attempt in range(max_attempts):
-        if not keep_running:
-            logging.info("程序停止中...")
-            return False
-
-        found, location, shape = check_image(image_path, region)
-        if found:
-            center_x = location[0] + shape[1] // 2
-            center_y = location[1] + shape[0] // 2
-            tap(center_x, center_y)
-            logging.info(f"找到並點擊了圖像: {image_path} at {center_x}, {center_y}")
-            time.sleep(delay)
-            return True
-        else:
-            logging.info(f"未找到圖像，嘗試 {attempt + 1}/{max_attempts}，將重試...")
-            time.sleep(delay)
-    
-    logging.error(f"在 {max_attempts} 次嘗試後仍未找到匹配的圖像: {image_path}")
+    if not keep_running:
+        logging.info("程序停止中...")
+        return False
+
+    timeout = timeout or waits.attempts_timeout(max_attempts, delay)
+    match = waits.wait_for_image(image_path, region, timeout=timeout, should_continue=lambda: keep_running)
+    if match.found:
+        center_x, center_y = matcher.center_of(match)
+        tap(center_x, center_y)
+        logging.info(f"找到並點擊了圖像: {image_path} at {center_x}, {center_y}")
+        adb_input.sleep(delay)
+        return True
+
+    if not keep_running:
+        logging.info("程序停止中...")
+        return False
+    logging.error(f"在 {timeout} 秒內仍未找到匹配的圖像: {image_path}")
     return False
 
 def click_images_in_sequence(image_paths, max_attempts=50, delay=0.5, region=None):
     """
     依序點擊多張圖片
+    每次擷取以同一幀比對所有尚未點擊的圖片: 後面的圖片已出現時略過前面已通過的步驟，同時可見的連續步驟一次點完
     """
-    for i, image_path in enumerate(image_paths, 1):
+    pending = []
+    for image_path in image_paths:
+        if not os.path.isfile(image_path):
+            logging.error(f"文件不存在: {image_path}")
+            continue
+        pending.append(image_path)
+
+    step = 0
+    attempt = 0
+    while step < len(pending):
         if not keep_running:
             logging.info("程序停止中...")
             return False
 
-        if not os.path.isfile(image_path):
-            logging.error(f"文件不存在: {image_path}")
+        screen = capture_screen()
+        matches = matcher.match_all(screen, pending[step:], region) if screen is not None else []
+        clicks = matcher.visible_run(matches)
+        if not clicks:
+            attempt += 1
+            if attempt < max_attempts:
+                logging.info(f"未找到第 {step + 1} 張圖片，嘗試 {attempt}/{max_attempts}，將重試...")
+                time.sleep(delay)
+                continue
+            logging.warning(f"無法點擊第 {step + 1} 張圖片: {pending[step]}，繼續下一張")
+            step += 1
+            attempt = 0
             continue
-        
-        logging.info(f"正在嘗試點擊第 {i} 張圖片: {image_path}")
-        if find_and_click_image(image_path, max_attempts=max_attempts, delay=delay, region=region):
-            logging.info(f"成功點擊第 {i} 張圖片: {image_path}")
-        else:
-            logging.warning(f"無法點擊第 {i} 張圖片: {image_path}，繼續下一張")
-        time.sleep(delay)
+
+        if clicks[0] > 0:
+            logging.info(f"後面的圖片已出現，略過已通過的 {clicks[0]} 張圖片 (從第 {step + 1} 張起)")
+        for index in clicks:
+            center_x, center_y = matcher.center_of(matches[index])
+            tap(center_x, center_y)
+            logging.info(f"成功點擊第 {step + index + 1} 張圖片: {pending[step + index]} at {center_x}, {center_y}")
+            adb_input.sleep(delay * 2)
+        step += clicks[-1] + 1
+        attempt = 0
     return True
 
 def click_until_next_image(click_coords, next_image_path, max_attempts=50, delay=2, region=None):
     """
     持續點擊指定坐標，直到能夠檢測到下一張圖片
+    waits.PIPELINED_CLICK 開啟時點擊與擷取/比對同時進行，偵測到圖片後立即停止點擊
     """
+    if waits.PIPELINED_CLICK:
+        if not keep_running:
+            logging.info("程序停止中...")
+            return False
+        result = waits.tap_until_image(click_coords, next_image_path, region, timeout=max_attempts * delay,
+                                       tap_interval=delay, should_continue=lambda: keep_running)
+        if result.found:
+            logging.info(f"檢測到下一張圖片: {next_image_path} (耗時 {result.elapsed:.2f} 秒，點擊 {result.taps} 次)")
+        else:
+            logging.error(f"在 {result.elapsed:.0f} 秒內仍未檢測到下一張圖片。(點擊 {result.taps} 次)")
+        return result.found
+
+    start = time.monotonic()
+    skipped = matcher.skipped_matches(next_image_path)
     for attempt in range(max_attempts):
         if not keep_running:
             logging.info("程序停止中...")
@@ -180,12 +203,12 @@ def click_until_next_image(click_coords, next_image_path, max_attempts=50, delay
         
         found, _, _ = check_image(next_image_path, region)
         if found:
-            logging.info(f"檢測到下一張圖片: {next_image_path}")
+            logging.info(f"檢測到下一張圖片: {next_image_path} (耗時 {time.monotonic() - start:.2f} 秒，快速檢查略過 {matcher.skipped_matches(next_image_path) - skipped} 次比對)")
             return True
         
         time.sleep(delay)
     
-    logging.error(f"在 {max_attempts} 次嘗試後仍未檢測到下一張圖片。")
+    logging.error(f"在 {max_attempts} 次嘗試後仍未檢測到下一張圖片。(快速檢查略過 {matcher.skipped_matches(next_image_path) - skipped} 次比對)")
     return False
 
 def click_and_print_coordinates():
@@ -221,9 +244,10 @@ def press_key(key, duration=1):
     :param key: 按鍵的字符
     :param duration: 按下的持續時間（秒）
     """
-    run_adb_command(f"shell input text {key}")
+    adb_input.input_text(key)
+    adb_capture.invalidate_frames()
     logging.info(f"按下按鍵: {key} 持續時間: {duration} 秒")
-    time.sleep(duration)
+    adb_input.sleep(duration)
     # 釋放按鍵不需要額外的命令，因為 `input text` 命令會自動完成按下和釋放
 
 def calculate_region(points):
@@ -251,10 +275,10 @@ def check_number_in_region(region):
         x, y, w, h = region
         screen_region = screen[y:y + h, x:x + w]
 
-        # 使用 pytesseract 進行 OCR
-        text = pytesseract.image_to_string(screen_region, config='--psm 6 digits')
-        logging.info(f"檢測到的數字: {text.strip()}")
-        return text.strip()
+        # 以字形模板辨識數字，無法辨識時才使用 pytesseract
+        text = digit_ocr.read_number(screen_region)
+        logging.info(f"檢測到的數字: {text}")
+        return text
     except Exception as e:
         logging.error(f"OCR 過程中發生錯誤: {str(e)}")
         return None
@@ -275,7 +299,7 @@ def main():
 
     # points = [(1007, 335), (1169, 338), (1004, 429), (1170, 433)]
     # print(calculate_region(points))
-
+    # region = (914, 26, 74, 22)  # 1280x720 的體力 "49/240"；(886, 24, 60, 37) 會包含圖示並切掉後半的數字
     # region = (886, 24, 60, 37)
     # detected_number = check_number_in_region(region)
     # if detected_number:
@@ -302,7 +326,7 @@ def main():
                 find_and_click_image("./photoForStar_Rail/send.png", region=(1008, 534, 162, 92))
             else:
                 swipe(657, 583, 657, 308, 3100)
-                time.sleep(1)
+                adb_input.sleep(1)
                 if choose_1 == "4":
                     find_and_click_image("./photoForStar_Rail/send.png", region=(1004, 335, 166, 98))
                 elif choose_1 == "5":
@@ -311,7 +335,7 @@ def main():
                     find_and_click_image("./photoForStar_Rail/send.png", region=(1008, 534, 162, 92))
                 else:
                     swipe(657, 583, 657, 300, 2800)
-                    time.sleep(1)
+                    adb_input.sleep(1)
                     if choose_1 == "7":
                         find_and_click_image("./photoForStar_Rail/send.png", region=(1004, 335, 166, 98))
                     elif choose_1 == "8":
@@ -320,8 +344,9 @@ def main():
                         find_and_click_image("./photoForStar_Rail/send.png", region=(1008, 534, 162, 92))
             
             if find_and_click_image("./photoForStar_Rail/startTo.png"):
-                time.sleep(3)
-                tee, _, _ = check_image("./photoForStar_Rail/universe.png")
+                # 第一次擷取排在 startTo 之後預期的延遲附近，而不是固定睡 3 秒
+                tee = latency.wait_for_image("startTo", "./photoForStar_Rail/universe.png", timeout=6,
+                                             since=time.monotonic(), should_continue=lambda: keep_running).found
                 if tee:
                     logging.info("成功進入差分宇宙!")
                 else:
@@ -5,7 +5,7 @@ a = Analysis(
     ['Star_UI.py'],
     pathex=[],
     binaries=[],
-    datas=[('index.html', '.'), ('photoForStar_Rail/*', 'photoForStar_Rail')],
+    datas=[('index.html', '.'), ('photoForStar_Rail/*', 'photoForStar_Rail'), ('screen_states.json', '.'), ('screen.png', '.'), ('flows/*', 'flows'), ('photoForStar_Rail/digits/*.png', 'photoForStar_Rail/digits')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,542 @@
+import subprocess
+import threading
+import time
+import shutil
+import struct
+import logging
+from collections import deque, namedtuple
+import cv2
+import numpy as np
+import adb_client
+import adb_device
+
+"""
+    螢幕擷取後端
+    stream   : 常駐 `adb exec-out screenrecord` H.264 串流，由本機 ffmpeg 解碼，
+               capture_screen() 直接讀取最新一幀
+    background: 背景線程持續以 raw 截圖填入環形緩衝區，讀取端只取最新一幀
+    raw      : 每次呼叫執行 `adb exec-out screencap`，直接讀取未壓縮的像素資料
+    screencap: 每次呼叫執行一次 `adb exec-out screencap -p`（原本的作法）
+    串流無法使用時退回 raw，raw 格式不支援時再退回 screencap
+    所有擷取都經過 FrameBus：同一個 UI 狀態內 (TTL 內且未點擊/滑動) 的檢查共用同一幀
+    串流、背景擷取與畫面快取都依裝置 serial 各自獨立，未指定 serial 時使用目前線程綁定的裝置
+"""
+# 擷取設定
+CAPTURE_MODE = "stream"  # "stream"、"background"、"raw" 或 "screencap"
+SCREEN_WIDTH = 1280
+SCREEN_HEIGHT = 720
+STREAM_BIT_RATE = 8000000
+FIRST_FRAME_TIMEOUT = 2.0  # 串流啟動後等待第一幀的秒數
+STREAM_MAX_FAILURES = 3  # 連續幾次啟動都沒有輸出任何畫面後，停用該裝置的串流
+FRAME_TTL = 0.2  # 畫面快取的有效秒數，0 表示不快取
+RING_SIZE = 4  # 背景擷取環形緩衝區的幀數
+RING_WAIT_TIMEOUT = 2.0  # 等待背景線程產生新幀的秒數
+STREAM_INPUT_TIMEOUT = 0.3  # 點擊/滑動後等待串流輸出新幀的秒數 (畫面沒有變化時 screenrecord 不輸出新幀)
+
+_streams = {}
+_stream_lock = threading.Lock()
+_stream_disabled = False
+_stream_failed = set()  # 串流無法輸出畫面 (模擬器不支援 screenrecord 或編碼器錯誤) 的裝置
+_raw_unsupported = False
+_rings = {}
+_frame_buses = {}
+_last_input_time = {}
+_stream_waited = {}  # 每台裝置已等待過新串流幀的輸入時間
+before_capture_hooks = []  # 每次擷取畫面前呼叫 (例如送出排隊中的輸入)
+
+# screencap 原始輸出的像素格式: 格式代碼 -> (每像素位元組數, BGR 通道索引)
+RAW_PIXEL_FORMATS = {
+    1: (4, slice(2, None, -1)),  # RGBA_8888
+    2: (4, slice(2, None, -1)),  # RGBX_8888
+    3: (3, slice(2, None, -1)),  # RGB_888
+    5: (4, slice(0, 3)),         # BGRA_8888
+}
+
+
+def exec_out(command, serial=None):
+    """
+    執行 `adb exec-out` 並回傳二進位輸出，優先使用 adb 協定連線
+    """
+    serial = adb_device.resolve_serial(serial)
+    if adb_client.USE_SOCKET_CLIENT:
+        try:
+            return adb_client.get_client(serial).exec_out(command)
+        except (OSError, adb_client.AdbError) as e:
+            logging.warning(f"ADB 協定連線失敗，改用 adb 程序: {str(e)}")
+            adb_client.mark_disconnected(serial)
+    target = f"-s {serial} " if serial else ""
+    result = subprocess.run(f"adb {target}exec-out {command}", shell=True, capture_output=True)
+    if result.returncode != 0:
+        logging.error(f"ADB exec-out 命令失敗: {command}，錯誤信息: {result.stderr.decode('utf-8', 'ignore')}")
+        adb_client.mark_disconnected(serial)
+        return None
+    return result.stdout
+
+
+def screencap_png(serial=None):
+    """
+    以 `screencap -p` 擷取一張截圖並解碼
+    """
+    data = exec_out("screencap -p", serial)
+    if not data:
+        return None
+    screen_np = np.frombuffer(data, np.uint8)
+    return cv2.imdecode(screen_np, cv2.IMREAD_COLOR)
+
+
+def decode_raw_screencap(data):
+    """
+    解析 `screencap` 原始輸出 (寬、高、格式標頭 + 像素資料)
+    回傳 BGR 順序的零拷貝 ndarray 視圖，格式不支援時回傳 None
+    """
+    if len(data) < 12:
+        return None
+    width, height, pixel_format = struct.unpack_from("<III", data, 0)
+    if pixel_format not in RAW_PIXEL_FORMATS:
+        return None
+    bpp, bgr = RAW_PIXEL_FORMATS[pixel_format]
+    pixel_bytes = width * height * bpp
+    # Android 9 之後標頭多了 4 位元組的 dataspace 欄位
+    header_size = len(data) - pixel_bytes
+    if header_size not in (12, 16):
+        return None
+    pixels = np.frombuffer(data, np.uint8, count=pixel_bytes, offset=header_size)
+    return pixels.reshape(height, width, bpp)[:, :, bgr]
+
+
+def screencap_raw(serial=None):
+    """
+    以未壓縮的 `screencap` 擷取截圖，省去裝置端 PNG 編碼與本機解碼
+    """
+    global _raw_unsupported
+    data = exec_out("screencap", serial)
+    if not data:
+        return None
+    screen = decode_raw_screencap(data)
+    if screen is None:
+        logging.warning("無法解析 screencap 原始格式，改用 PNG 截圖")
+        _raw_unsupported = True
+        return screencap_png(serial)
+    return screen
+
+
+class ScreenStream:
+    """
+    常駐的螢幕串流，背景線程持續解碼並保留最新一幀
+    """
+    def __init__(self, serial=None, width=SCREEN_WIDTH, height=SCREEN_HEIGHT, bit_rate=STREAM_BIT_RATE):
+        self.serial = serial
+        self.width = width
+        self.height = height
+        self.bit_rate = bit_rate
+        self.frame_count = 0
+        self._frame = None
+        self._frame_time = 0.0
+        self._first_frame = threading.Event()
+        self._new_frame = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._adb_proc = None
+        self._ffmpeg_proc = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logging.info("螢幕串流已啟動")
+
+    def stop(self):
+        self._running = False
+        self._kill_processes()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        logging.info("螢幕串流已停止")
+
+    def is_alive(self):
+        return self._running and self._thread is not None and self._thread.is_alive()
+
+    def wait_first_frame(self, timeout=FIRST_FRAME_TIMEOUT):
+        return self._first_frame.wait(timeout)
+
+    def latest_frame(self):
+        """
+        取得最新解碼的畫面，不會阻塞
+        """
+        return self._frame
+
+    def frame_after(self, after, timeout=STREAM_INPUT_TIMEOUT):
+        """
+        等待在 after (time.time()) 之後才解碼的畫面；逾時時回傳最新一幀
+        """
+        with self._new_frame:
+            self._new_frame.wait_for(lambda: self._frame_time > after or not self._running, timeout)
+            return self._frame
+
+    def frame_age(self):
+        """
+        最新畫面距今的秒數（screenrecord 只在畫面變化時輸出新幀）
+        """
+        if self._frame is None:
+            return None
+        return time.time() - self._frame_time
+
+    def _spawn(self):
+        ffmpeg = shutil.which("ffmpeg")
+        target = ["-s", self.serial] if self.serial else []
+        adb_cmd = [
+            "adb", *target, "exec-out", "screenrecord",
+            "--output-format=h264",
+            f"--size={self.width}x{self.height}",
+            f"--bit-rate={self.bit_rate}",
+            "-",
+        ]
+        ffmpeg_cmd = [
+            ffmpeg, "-loglevel", "error",
+            "-fflags", "nobuffer", "-flags", "low_delay",
+            "-f", "h264", "-i", "pipe:0",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1",
+        ]
+        self._adb_proc = subprocess.Popen(adb_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._ffmpeg_proc = subprocess.Popen(ffmpeg_cmd, stdin=self._adb_proc.stdout,
+                                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        # 讓 ffmpeg 成為管道唯一的讀取端
+        self._adb_proc.stdout.close()
+
+    def _kill_processes(self):
+        for proc in (self._ffmpeg_proc, self._adb_proc):
+            if proc is not None and proc.poll() is None:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+        self._adb_proc = None
+        self._ffmpeg_proc = None
+
+    def _run(self):
+        frame_size = self.width * self.height * 3
+        failures = 0
+        while self._running:
+            frames_before = self.frame_count
+            try:
+                self._spawn()
+                stdout = self._ffmpeg_proc.stdout
+                while self._running:
+                    data = stdout.read(frame_size)
+                    if len(data) < frame_size:
+                        break
+                    with self._new_frame:
+                        self._frame = np.frombuffer(data, np.uint8).reshape(self.height, self.width, 3)
+                        self._frame_time = time.time()
+                        self.frame_count += 1
+                        self._new_frame.notify_all()
+                    self._first_frame.set()
+            except Exception as e:
+                logging.error(f"螢幕串流發生錯誤: {str(e)}")
+            finally:
+                self._kill_processes()
+            # 連續啟動都沒有輸出畫面時不再重試，之後的擷取改用 screencap
+            failures = failures + 1 if self.frame_count == frames_before else 0
+            if failures >= STREAM_MAX_FAILURES:
+                logging.warning(f"螢幕串流連續 {failures} 次沒有輸出畫面，停用串流並改用 screencap")
+                with _stream_lock:
+                    _stream_failed.add(self.serial)
+                self._running = False
+                with self._new_frame:
+                    self._new_frame.notify_all()
+                break
+            # screenrecord 有 3 分鐘的錄影上限，結束後自動重新連線
+            if self._running:
+                logging.info("螢幕串流中斷，重新連線...")
+                time.sleep(0.5)
+
+
+# 環形緩衝區中的一幀: 序號、開始擷取時間、擷取完成時間、畫面
+CapturedFrame = namedtuple("CapturedFrame", ["seq", "start_time", "end_time", "frame"])
+
+
+def capture_once(serial=None):
+    """
+    依設定執行一次單張截圖 (raw 或 PNG)
+    """
+    if CAPTURE_MODE == "screencap" or _raw_unsupported:
+        return screencap_png(serial)
+    return screencap_raw(serial)
+
+
+class CaptureRing:
+    """
+    背景擷取線程 + 環形緩衝區
+    只有擷取線程會寫入，讀取端只讀最新的槽位，不需要鎖
+    """
+    def __init__(self, size=RING_SIZE, source=None):
+        self.size = size
+        self.source = source or capture_once
+        self.dropped = 0
+        self.consumed = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=100)
+        self._slots = [None] * size
+        self._seq = 0
+        self._last_read_seq = 0
+        self._new_frame = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logging.info("背景擷取線程已啟動")
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        logging.info("背景擷取線程已停止")
+
+    def is_alive(self):
+        return self._running and self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while self._running:
+            start_time = time.time()
+            try:
+                frame = self.source()
+            except Exception as e:
+                logging.error(f"背景擷取發生錯誤: {str(e)}")
+                frame = None
+            end_time = time.time()
+            if frame is None:
+                self.failures += 1
+                time.sleep(0.1)
+                continue
+            seq = self._seq + 1
+            self._slots[seq % self.size] = CapturedFrame(seq, start_time, end_time, frame)
+            self._seq = seq
+            self.latencies.append(end_time - start_time)
+            self._new_frame.set()
+
+    def latest(self, after=0.0, timeout=RING_WAIT_TIMEOUT):
+        """
+        取得最新一幀；after 指定時，只接受在該時間之後才開始擷取的畫面
+        """
+        deadline = time.time() + timeout
+        while True:
+            self._new_frame.clear()
+            entry = self._slots[self._seq % self.size]
+            if entry is not None and entry.start_time >= after:
+                if entry.seq > self._last_read_seq:
+                    self.dropped += entry.seq - self._last_read_seq - 1
+                    self._last_read_seq = entry.seq
+                    self.consumed += 1
+                return entry
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.is_alive():
+                return None
+            self._new_frame.wait(remaining)
+
+    def stats(self):
+        """
+        擷取統計: 已產生/已讀取/被覆蓋未讀的幀數，以及擷取延遲 (毫秒)
+        """
+        latencies = list(self.latencies)
+        return {
+            "produced": self._seq,
+            "consumed": self.consumed,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "avg_latency_ms": sum(latencies) * 1000 / len(latencies) if latencies else None,
+            "max_latency_ms": max(latencies) * 1000 if latencies else None,
+        }
+
+
+def start_background_capture(serial=None):
+    """
+    啟動指定裝置的背景擷取線程
+    """
+    serial = adb_device.resolve_serial(serial)
+    with _stream_lock:
+        ring = _rings.get(serial)
+        if ring is None or not ring.is_alive():
+            ring = CaptureRing(source=lambda: capture_once(serial))
+            ring.start()
+            _rings[serial] = ring
+    return ring
+
+
+def stop_background_capture(serial=None):
+    serial = adb_device.resolve_serial(serial)
+    with _stream_lock:
+        ring = _rings.pop(serial, None)
+    if ring is not None:
+        ring.stop()
+
+
+def capture_stats(serial=None):
+    """
+    背景擷取線程的統計資料，未啟動時回傳 None
+    """
+    ring = _rings.get(adb_device.resolve_serial(serial))
+    return ring.stats() if ring is not None else None
+
+
+def start_stream(serial=None):
+    """
+    啟動指定裝置的螢幕串流，ffmpeg 不存在時回傳 None
+    """
+    global _stream_disabled
+    serial = adb_device.resolve_serial(serial)
+    with _stream_lock:
+        stream = _streams.get(serial)
+        if stream is not None and stream.is_alive():
+            return stream
+        if _stream_disabled or serial in _stream_failed:
+            return None
+        if shutil.which("ffmpeg") is None:
+            logging.warning("找不到 ffmpeg，改用 screencap 擷取螢幕")
+            _stream_disabled = True
+            return None
+        stream = ScreenStream(serial)
+        stream.start()
+        _streams[serial] = stream
+    if not stream.wait_first_frame():
+        logging.warning("螢幕串流尚未輸出畫面，暫時改用 screencap")
+    return stream
+
+
+def stop_stream(serial=None):
+    serial = adb_device.resolve_serial(serial)
+    with _stream_lock:
+        stream = _streams.pop(serial, None)
+    if stream is not None:
+        stream.stop()
+
+
+def grab_frame(serial=None):
+    """
+    不經快取，直接從擷取後端取得一幀
+    """
+    serial = adb_device.resolve_serial(serial)
+    if CAPTURE_MODE == "stream":
+        stream = _streams.get(serial)
+        if stream is None or not stream.is_alive():
+            stream = start_stream(serial)
+        if stream is not None:
+            # 點擊/滑動之後，等待輸入之後才解碼的畫面；每次輸入只等一次，畫面沒有變化時之後直接用最新一幀
+            after = _last_input_time.get(serial, 0.0)
+            if after > _stream_waited.get(serial, 0.0):
+                _stream_waited[serial] = after
+                frame = stream.frame_after(after)
+            else:
+                frame = stream.latest_frame()
+            if frame is not None:
+                return frame
+    elif CAPTURE_MODE == "background":
+        # 點擊/滑動之後，只接受在輸入之後才開始擷取的畫面
+        entry = start_background_capture(serial).latest(after=_last_input_time.get(serial, 0.0))
+        if entry is not None:
+            return entry.frame
+    return capture_once(serial)
+
+
+class FrameBus:
+    """
+    共用畫面快取: TTL 內的多次檢查共用同一幀，點擊/滑動後須呼叫 invalidate()
+    """
+    def __init__(self, ttl=None, source=None):
+        self.ttl = FRAME_TTL if ttl is None else ttl
+        self.source = source or grab_frame
+        self.hits = 0
+        self.misses = 0
+        self._frame = None
+        self._frame_time = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._frame is not None and time.time() - self._frame_time < self.ttl:
+                self.hits += 1
+                return self._frame
+            self.misses += 1
+            frame = self.source()
+            if frame is None:
+                self._frame = None
+                return None
+            self._frame = frame
+            self._frame_time = time.time()
+            return frame
+
+    def invalidate(self):
+        with self._lock:
+            self._frame = None
+
+
+def get_frame_bus(serial=None):
+    """
+    取得指定裝置的畫面快取
+    """
+    serial = adb_device.resolve_serial(serial)
+    with _stream_lock:
+        bus = _frame_buses.get(serial)
+        if bus is None:
+            bus = FrameBus(source=lambda: grab_frame(serial))
+            _frame_buses[serial] = bus
+    return bus
+
+
+def invalidate_frames(serial=None):
+    """
+    畫面即將改變 (點擊、滑動、輸入) 時丟棄快取的畫面
+    """
+    serial = adb_device.resolve_serial(serial)
+    _last_input_time[serial] = time.time()
+    get_frame_bus(serial).invalidate()
+
+
+def capture_screen(serial=None):
+    """
+    擷取目前螢幕畫面 (BGR ndarray)，串流無法使用時退回單次截圖
+    """
+    serial = adb_device.resolve_serial(serial)
+    for hook in before_capture_hooks:
+        hook(serial)
+    return get_frame_bus(serial).get()
+
+
+def benchmark_decode(image_path="screen.png", rounds=50):
+    """
+    比較 PNG 解碼與原始格式解析的耗時 (僅本機部分，不含裝置端編碼)
+    """
+    image = cv2.imread(image_path)
+    if image is None:
+        print(f"無法讀取圖像: {image_path}")
+        return
+    height, width = image.shape[:2]
+    png_data = cv2.imencode(".png", image)[1].tobytes()
+    rgba = cv2.cvtColor(image, cv2.COLOR_BGR2RGBA)
+    raw_data = struct.pack("<IIII", width, height, 1, 0) + rgba.tobytes()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        png_screen = cv2.imdecode(np.frombuffer(png_data, np.uint8), cv2.IMREAD_COLOR)
+    png_ms = (time.perf_counter() - start) * 1000 / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        raw_screen = decode_raw_screencap(raw_data)
+    raw_ms = (time.perf_counter() - start) * 1000 / rounds
+
+    assert np.array_equal(png_screen, raw_screen)
+    print(f"畫面大小: {width}x{height}，PNG {len(png_data)} 位元組，原始 {len(raw_data)} 位元組")
+    print(f"PNG 解碼: {png_ms:.3f} ms/幀")
+    print(f"原始解析: {raw_ms:.3f} ms/幀")
+
+
+if __name__ == "__main__":
+    benchmark_decode()
@@ -0,0 +1,275 @@
+import socket
+import subprocess
+import threading
+import logging
+import adb_device
+
+"""
+    ADB 協定客戶端
+    直接以 socket 連到本機 adb server (預設 127.0.0.1:5037)，不再為每個命令啟動 adb 程序
+    請求格式: 4 位十六進位長度 + 命令，例如 "000Chost:version"
+    回應: "OKAY" 或 "FAIL" + 4 位十六進位長度 + 錯誤訊息
+    裝置連線只在第一次使用時建立並快取，之後只有實際命令失敗才會標記為中斷，
+    下一次 setup_adb() 時再重新連線
+"""
+# 連線設定
+ADB_HOST = "127.0.0.1"
+ADB_PORT = 5037
+SOCKET_TIMEOUT = 10
+POOL_SIZE = 2  # 預先建立並選好裝置的連線數
+USE_SOCKET_CLIENT = True  # False 時 run_adb_command 一律使用 adb 程序
+
+_clients = {}
+_connections = {}  # serial (None 表示預設裝置) -> 實際連線的裝置 serial
+_client_lock = threading.Lock()
+
+
+class AdbError(Exception):
+    pass
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise AdbError("adb server 連線中斷")
+        data += chunk
+    return data
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+class AdbClient:
+    """
+    adb server 協定客戶端
+    adb 的每條連線只能執行一個服務 (shell:/exec:)，因此連線池中保存的是
+    已連線且已切換到目標裝置 (host:transport) 的連線，使用時只需送出服務請求
+    """
+    def __init__(self, host=ADB_HOST, port=ADB_PORT, serial=None, pool_size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.serial = serial
+        self.pool_size = pool_size
+        self._pool = []
+        self._pool_lock = threading.Lock()
+        self._refilling = False
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=SOCKET_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def _send(sock, request):
+        payload = request.encode("utf-8")
+        sock.sendall(b"%04x" % len(payload) + payload)
+        status = _recv_exact(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            length = int(_recv_exact(sock, 4), 16)
+            message = _recv_exact(sock, length).decode("utf-8", "ignore")
+            raise AdbError(f"{request}: {message}")
+        raise AdbError(f"{request}: 未知的回應 {status!r}")
+
+    def host_command(self, request):
+        """
+        執行 host: 命令 (例如 host:version、host:devices) 並回傳內容
+        """
+        with self._connect() as sock:
+            self._send(sock, request)
+            length = int(_recv_exact(sock, 4), 16)
+            return _recv_exact(sock, length).decode("utf-8", "ignore")
+
+    def version(self):
+        return int(self.host_command("host:version"), 16)
+
+    def devices(self):
+        """
+        回傳 [(serial, state), ...]
+        """
+        devices = []
+        for line in self.host_command("host:devices").splitlines():
+            if "\t" in line:
+                serial, state = line.split("\t", 1)
+                devices.append((serial, state))
+        return devices
+
+    def _open_transport(self):
+        sock = self._connect()
+        try:
+            if self.serial:
+                self._send(sock, f"host:transport:{self.serial}")
+            else:
+                self._send(sock, "host:transport-any")
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _acquire(self):
+        with self._pool_lock:
+            if self._pool:
+                return self._pool.pop(), True
+        return self._open_transport(), False
+
+    def _refill(self):
+        try:
+            while True:
+                with self._pool_lock:
+                    if len(self._pool) >= self.pool_size:
+                        return
+                sock = self._open_transport()
+                with self._pool_lock:
+                    self._pool.append(sock)
+        except (OSError, AdbError):
+            pass
+        finally:
+            self._refilling = False
+
+    def _schedule_refill(self):
+        if self.pool_size <= 0 or self._refilling:
+            return
+        self._refilling = True
+        threading.Thread(target=self._refill, daemon=True).start()
+
+    def service(self, request):
+        """
+        在裝置上執行服務 (shell:/exec:) 並讀取全部輸出；池中連線失效時改用新連線重試
+        """
+        for attempt in range(2):
+            sock, pooled = self._acquire() if attempt == 0 else (self._open_transport(), False)
+            try:
+                with sock:
+                    self._send(sock, request)
+                    return _recv_all(sock)
+            except (OSError, AdbError):
+                if not pooled:
+                    raise
+                self.clear_pool()
+            finally:
+                self._schedule_refill()
+
+    def shell(self, command):
+        return self.service(f"shell:{command}").decode("utf-8", "ignore")
+
+    def exec_out(self, command):
+        """
+        exec: 服務不經過 pty，適合讀取二進位輸出 (例如 screencap)
+        """
+        return self.service(f"exec:{command}")
+
+    def clear_pool(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, []
+        for sock in pool:
+            sock.close()
+
+    def close(self):
+        self.clear_pool()
+
+
+def get_client(serial=None):
+    """
+    取得指定裝置的客戶端 (每個 serial 各自一個連線池)
+    """
+    serial = adb_device.resolve_serial(serial)
+    with _client_lock:
+        if serial not in _clients:
+            _clients[serial] = AdbClient(serial=serial)
+        return _clients[serial]
+
+
+def list_devices():
+    """
+    回傳所有狀態為 device 的裝置 serial
+    """
+    try:
+        devices = get_client().devices()
+    except (OSError, AdbError):
+        output = run_adb_command("devices")
+        devices = [tuple(line.split("\t", 1)) for line in output.splitlines()[1:] if "\t" in line]
+    return [serial for serial, state in devices if state == "device"]
+
+
+def is_connected(serial=None):
+    return adb_device.resolve_serial(serial) in _connections
+
+
+def connect(serial=None):
+    """
+    啟動 adb server 並確認裝置已連接，成功時快取並回傳裝置 serial，否則回傳 None
+    """
+    key = adb_device.resolve_serial(serial)
+    start_server()
+    devices = list_devices()
+    if key is None:
+        found = devices[0] if devices else None
+    else:
+        found = key if key in devices else None
+    if found is None:
+        return None
+    _connections[key] = found
+    return found
+
+
+def mark_disconnected(serial=None):
+    """
+    命令失敗時呼叫: 丟棄快取的連線，下次 setup_adb() 時重新連線
+    """
+    key = adb_device.resolve_serial(serial)
+    found = _connections.pop(key, None)
+    if found is not None:
+        logging.warning(f"裝置 {found} 連線中斷，將在下次使用時重新連線")
+    client = _clients.get(key)
+    if client is not None:
+        client.clear_pool()
+
+
+def start_server():
+    """
+    確認 adb server 已啟動；無法連線時才執行一次 `adb start-server`
+    """
+    try:
+        get_client().version()
+        return
+    except (OSError, AdbError):
+        pass
+    logging.info("adb server 未啟動，執行 adb start-server")
+    subprocess.run("adb start-server", shell=True)
+
+
+def run_adb_command(command, serial=None):
+    """
+    以 adb 協定執行 adb 命令 (devices、shell ...、exec-out ...)，回傳與 adb 程序相同的輸出
+    其他命令或無法連線時改用 adb 程序；serial 指定目標裝置
+    """
+    serial = adb_device.resolve_serial(serial)
+    if USE_SOCKET_CLIENT:
+        name, _, args = command.partition(" ")
+        try:
+            client = get_client(serial)
+            if name == "devices" and not args:
+                lines = [f"{serial}\t{state}" for serial, state in client.devices()]
+                return "\n".join(["List of devices attached", *lines]).strip()
+            if name == "shell" and args:
+                return client.shell(args).strip()
+            if name == "exec-out" and args:
+                return client.exec_out(args).decode("utf-8", "ignore").strip()
+        except (OSError, AdbError) as e:
+            logging.warning(f"ADB 協定連線失敗，改用 adb 程序: {str(e)}")
+            mark_disconnected(serial)
+    full_command = f"adb -s {serial} {command}" if serial else f"adb {command}"
+    result = subprocess.run(full_command, shell=True, capture_output=True, text=True)
+    if result.returncode != 0:
+        logging.error(f"ADB命令執行失敗: {full_command}，錯誤信息: {result.stderr}")
+        mark_disconnected(serial)
+    return result.stdout.strip()
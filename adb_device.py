@@ -0,0 +1,39 @@
+import threading
+
+"""
+    裝置上下文
+    每個線程可以綁定一台裝置 (serial) 與自己的執行控制，
+    adb_client / adb_capture / adb_input 在未指定 serial 時使用目前線程綁定的裝置
+"""
+_context = threading.local()
+
+
+def use_device(serial, worker=None):
+    """
+    將目前線程綁定到指定裝置；worker 提供該裝置自己的 keep_running 控制
+    """
+    _context.serial = serial
+    _context.worker = worker
+
+
+def current_serial():
+    """
+    目前線程綁定的裝置 serial，未綁定時為 None (使用唯一連接的裝置)
+    """
+    return getattr(_context, "serial", None)
+
+
+def current_worker():
+    return getattr(_context, "worker", None)
+
+
+def worker_running():
+    """
+    目前線程所屬的工作是否仍應繼續執行，未綁定工作時永遠為 True
+    """
+    worker = current_worker()
+    return worker is None or worker.keep_running
+
+
+def resolve_serial(serial=None):
+    return serial if serial is not None else current_serial()
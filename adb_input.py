@@ -0,0 +1,385 @@
+import subprocess
+import threading
+import queue
+import time
+import atexit
+import re
+import logging
+import adb_client
+import adb_capture
+import adb_device
+
+"""
+    輸入通道
+    shell     : 常駐一個 `adb shell`，透過 stdin 寫入命令，以結束標記分隔每個命令的輸出
+    subprocess: 每次命令各自執行 (經 adb 協定連線，或 `adb shell ...`)，亦為備援
+    sendevent : 經由常駐 shell 直接對觸控裝置 /dev/input/eventN 寫入觸控事件，
+                不必每次點擊都啟動 Java 的 `input` 命令
+    BATCH_INPUT 開啟時，連續的點擊/滑動/等待先放入佇列，下一次擷取畫面前
+    合併成一個以 `;` 串接的 shell 命令送出 (等待改在裝置端以 sleep 執行)
+    shell 通道、輸入佇列與觸控裝置都依裝置 serial 各自獨立
+"""
+# 輸入設定
+INPUT_BACKEND = "shell"  # "shell"、"subprocess" 或 "sendevent"
+COMMAND_TIMEOUT = 10  # 等待單一命令完成的秒數
+SENTINEL = "__ADB_DONE__"
+BATCH_INPUT = True  # 合併連續的輸入動作
+MAX_BATCH = 20  # 佇列中累積的動作數達到上限時立即送出
+SWIPE_STEP_MS = 20  # sendevent 滑動時每一步的間隔 (毫秒)
+
+# Linux input 事件代碼
+EV_SYN, EV_KEY, EV_ABS = 0, 1, 3
+SYN_REPORT = 0
+BTN_TOUCH = 330
+ABS_MT_POSITION_X, ABS_MT_POSITION_Y, ABS_MT_TRACKING_ID = 0x35, 0x36, 0x39
+
+_sessions = {}
+_session_lock = threading.Lock()
+_touch_devices = {}
+_input_queues = {}
+
+
+class ShellSession:
+    """
+    常駐的 adb shell 連線，斷線時自動重新連線
+    """
+    def __init__(self, adb_args=None):
+        self.adb_args = adb_args or []
+        self.reconnects = 0
+        self._proc = None
+        self._lines = None
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self.close()
+        self._proc = subprocess.Popen(
+            ["adb", *self.adb_args, "shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding="utf-8",
+            errors="ignore",
+            bufsize=1,
+        )
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read_output, args=(self._proc, self._lines), daemon=True).start()
+        logging.info("ADB shell 通道已建立")
+
+    def close(self):
+        if self._proc is not None:
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+            if self._proc.poll() is None:
+                self._proc.kill()
+        self._proc = None
+
+    def is_alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    @staticmethod
+    def _read_output(proc, lines):
+        for line in proc.stdout:
+            lines.put(line.rstrip("\r\n"))
+        # 通道關閉
+        lines.put(None)
+
+    def _write(self, command):
+        self._counter += 1
+        marker = f"{SENTINEL}{self._counter}:"
+        self._proc.stdin.write(f"{command}; echo {marker}$?\n")
+        self._proc.stdin.flush()
+        return marker
+
+    def _read_result(self, marker, timeout):
+        output = []
+        while True:
+            line = self._lines.get(timeout=timeout)
+            if line is None:
+                raise ConnectionError("ADB shell 通道已關閉")
+            if marker in line:
+                before, _, code = line.partition(marker)
+                if before:
+                    output.append(before)
+                return "\n".join(output).strip(), int(code or 0)
+            output.append(line)
+
+    def run(self, command, timeout=COMMAND_TIMEOUT):
+        """
+        在常駐 shell 中執行命令，回傳 (輸出, 返回碼)
+        寫入前通道已中斷時重新連線並重試一次；命令寫入後逾時或中斷時不重送 (可能已在裝置上執行，
+        重送會讓點擊/滑動執行兩次)，關閉通道並拋出 TimeoutError
+        """
+        with self._lock:
+            for attempt in range(2):
+                if not self.is_alive():
+                    if attempt or self._proc is not None:
+                        self.reconnects += 1
+                    self.connect()
+                try:
+                    marker = self._write(command)
+                except (OSError, ValueError) as e:
+                    logging.warning(f"ADB shell 通道中斷，重新連線: {str(e)}")
+                    self.close()
+                    continue
+                try:
+                    return self._read_result(marker, timeout)
+                except (ConnectionError, queue.Empty) as e:
+                    self.close()
+                    raise TimeoutError(f"ADB shell 命令已送出但未完成: {command}") from e
+            raise ConnectionError(f"無法透過 ADB shell 執行命令: {command}")
+
+
+def get_session(serial=None):
+    serial = adb_device.resolve_serial(serial)
+    with _session_lock:
+        if serial not in _sessions:
+            _sessions[serial] = ShellSession(["-s", serial] if serial else None)
+        return _sessions[serial]
+
+
+def close_session(serial=None):
+    serial = adb_device.resolve_serial(serial)
+    with _session_lock:
+        session = _sessions.pop(serial, None)
+    if session is not None:
+        session.close()
+
+
+def shell(command, timeout=COMMAND_TIMEOUT, serial=None):
+    """
+    在裝置上執行 shell 命令並回傳輸出
+    """
+    serial = adb_device.resolve_serial(serial)
+    if INPUT_BACKEND != "subprocess":
+        try:
+            output, code = get_session(serial).run(command, timeout)
+            if code != 0:
+                logging.error(f"ADB命令執行失敗: shell {command}，返回碼: {code}，輸出: {output}")
+            return output
+        except TimeoutError as e:
+            # 命令可能已執行，不改用單次 adb 命令重送
+            logging.error(f"{str(e)}，不重新送出")
+            return ""
+        except ConnectionError as e:
+            logging.error(f"{str(e)}，改用單次 adb 命令")
+            adb_client.mark_disconnected(serial)
+    return adb_client.run_adb_command(f"shell {command}", serial)
+
+
+class TouchDevice:
+    """
+    觸控裝置 (多點觸控協定 B)，負責把螢幕座標換算成裝置軸座標並產生 sendevent 命令
+    """
+    def __init__(self, path, x_range, y_range, screen_size=None):
+        self.path = path
+        self.x_min, self.x_max = x_range
+        self.y_min, self.y_max = y_range
+        self.screen_width, self.screen_height = screen_size or (adb_capture.SCREEN_WIDTH, adb_capture.SCREEN_HEIGHT)
+        self._tracking_id = 0
+
+    def _scale(self, x, y):
+        dev_x = self.x_min + x * (self.x_max - self.x_min) // max(self.screen_width - 1, 1)
+        dev_y = self.y_min + y * (self.y_max - self.y_min) // max(self.screen_height - 1, 1)
+        return dev_x, dev_y
+
+    def _event(self, ev_type, code, value):
+        return f"sendevent {self.path} {ev_type} {code} {value}"
+
+    def _down(self, x, y):
+        self._tracking_id += 1
+        dev_x, dev_y = self._scale(x, y)
+        return [
+            self._event(EV_ABS, ABS_MT_TRACKING_ID, self._tracking_id),
+            self._event(EV_ABS, ABS_MT_POSITION_X, dev_x),
+            self._event(EV_ABS, ABS_MT_POSITION_Y, dev_y),
+            self._event(EV_KEY, BTN_TOUCH, 1),
+            self._event(EV_SYN, SYN_REPORT, 0),
+        ]
+
+    def _move(self, x, y):
+        dev_x, dev_y = self._scale(x, y)
+        return [
+            self._event(EV_ABS, ABS_MT_POSITION_X, dev_x),
+            self._event(EV_ABS, ABS_MT_POSITION_Y, dev_y),
+            self._event(EV_SYN, SYN_REPORT, 0),
+        ]
+
+    def _up(self):
+        return [
+            # tracking id -1 (以無號整數表示) 代表手指離開
+            self._event(EV_ABS, ABS_MT_TRACKING_ID, 4294967295),
+            self._event(EV_KEY, BTN_TOUCH, 0),
+            self._event(EV_SYN, SYN_REPORT, 0),
+        ]
+
+    def tap_command(self, x, y):
+        return "; ".join(self._down(x, y) + self._up())
+
+    def swipe_command(self, x1, y1, x2, y2, duration=500):
+        steps = max(1, duration // SWIPE_STEP_MS)
+        commands = self._down(x1, y1)
+        for i in range(1, steps + 1):
+            commands.append(f"sleep {duration / steps / 1000:g}")
+            commands += self._move(x1 + (x2 - x1) * i // steps, y1 + (y2 - y1) * i // steps)
+        return "; ".join(commands + self._up())
+
+
+def parse_touch_device(getevent_output):
+    """
+    從 `getevent -p` 的輸出中找出具有多點觸控座標軸的裝置
+    """
+    for block in re.split(r"(?=add device \d+:)", getevent_output):
+        path = re.search(r"add device \d+:\s*(\S+)", block)
+        x_axis = re.search(r"0035\s*:\s*value -?\d+, min (-?\d+), max (-?\d+)", block)
+        y_axis = re.search(r"0036\s*:\s*value -?\d+, min (-?\d+), max (-?\d+)", block)
+        if path and x_axis and y_axis:
+            return TouchDevice(path.group(1),
+                               (int(x_axis.group(1)), int(x_axis.group(2))),
+                               (int(y_axis.group(1)), int(y_axis.group(2))))
+    return None
+
+
+def get_touch_device(serial=None):
+    """
+    第一次使用時偵測觸控裝置及其座標範圍，之後沿用結果 (找不到時記錄為 None)
+    """
+    serial = adb_device.resolve_serial(serial)
+    if serial not in _touch_devices:
+        device = parse_touch_device(shell("getevent -p", serial=serial))
+        if device is None:
+            logging.warning("找不到觸控裝置，改用 input 命令")
+        else:
+            logging.info(f"觸控裝置: {device.path} "
+                         f"X {device.x_min}-{device.x_max} Y {device.y_min}-{device.y_max}")
+        _touch_devices[serial] = device
+    return _touch_devices[serial]
+
+
+class InputQueue:
+    """
+    輸入動作佇列: 收集連續的輸入命令與等待，flush() 時一次送到裝置
+    """
+    def __init__(self, serial=None, max_batch=MAX_BATCH):
+        self.serial = serial
+        self.max_batch = max_batch
+        self.batches = 0
+        self.actions_sent = 0
+        self._actions = []
+        self._lock = threading.Lock()
+
+    def add(self, command):
+        with self._lock:
+            self._actions.append(command)
+            full = len(self._actions) >= self.max_batch
+        if full:
+            self.flush()
+
+    def sleep(self, seconds):
+        """
+        佇列中有尚未送出的動作時，等待改在裝置端執行；否則直接在本機等待
+        """
+        with self._lock:
+            queued = bool(self._actions)
+            if queued:
+                if isinstance(self._actions[-1], float):
+                    self._actions[-1] += seconds
+                else:
+                    self._actions.append(float(seconds))
+        if not queued:
+            time.sleep(seconds)
+
+    def pending(self):
+        return len(self._actions)
+
+    def flush(self):
+        with self._lock:
+            actions, self._actions = self._actions, []
+            if not actions:
+                return
+            parts = []
+            wait = 0.0
+            for action in actions:
+                if isinstance(action, float):
+                    parts.append(f"sleep {action:g}")
+                    wait += action
+                else:
+                    parts.append(action)
+            shell("; ".join(parts), timeout=COMMAND_TIMEOUT + wait, serial=self.serial)
+            self.batches += 1
+            self.actions_sent += len(parts)
+        adb_capture.invalidate_frames(self.serial)
+
+
+def get_input_queue(serial=None):
+    serial = adb_device.resolve_serial(serial)
+    with _session_lock:
+        if serial not in _input_queues:
+            _input_queues[serial] = InputQueue(serial)
+        return _input_queues[serial]
+
+
+def flush_input(serial=None):
+    """
+    送出佇列中所有尚未執行的輸入動作
+    """
+    get_input_queue(serial).flush()
+
+
+def flush_all_inputs():
+    for input_queue in list(_input_queues.values()):
+        input_queue.flush()
+
+
+def sleep(seconds, serial=None):
+    """
+    輸入動作之後的等待，批次模式下與動作一起在裝置端執行
+    """
+    if BATCH_INPUT:
+        get_input_queue(serial).sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def send_input(command, serial=None):
+    if BATCH_INPUT:
+        get_input_queue(serial).add(command)
+    else:
+        shell(command, serial=serial)
+
+
+def tap(x, y, serial=None):
+    """
+    在指定坐標點擊
+    """
+    device = get_touch_device(serial) if INPUT_BACKEND == "sendevent" else None
+    if device is not None:
+        send_input(device.tap_command(x, y), serial)
+    else:
+        send_input(f"input tap {x} {y}", serial)
+
+
+def swipe(x1, y1, x2, y2, duration=500, serial=None):
+    """
+    從一個坐標滑動到另一個坐標
+    """
+    device = get_touch_device(serial) if INPUT_BACKEND == "sendevent" else None
+    if device is not None:
+        send_input(device.swipe_command(x1, y1, x2, y2, duration), serial)
+    else:
+        send_input(f"input swipe {x1} {y1} {x2} {y2} {duration}", serial)
+
+
+def input_text(text, serial=None):
+    """
+    輸入文字
+    """
+    send_input(f"input text {text}", serial)
+
+
+# 擷取畫面前先送出該裝置排隊中的輸入，程式結束時也一併送出
+adb_capture.before_capture_hooks.append(flush_input)
+atexit.register(flush_all_inputs)
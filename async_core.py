@@ -0,0 +1,211 @@
+import asyncio
+import time
+import logging
+import adb_client
+import adb_capture
+import adb_device
+import adb_input
+import matcher
+import template_store
+
+"""
+    asyncio 版本的核心操作: 擷取、點擊/滑動、等待圖像
+    直接以 asyncio socket 連到 adb server，一個事件迴圈可以同時驅動多台裝置與多個等待
+    同步版本 (各腳本原本的函數) 不變，另外提供 *_sync 包裝供同步程式呼叫
+"""
+POLL_INTERVAL = 0.1  # wait_for_image 兩次擷取之間的間隔 (秒)
+
+
+class AsyncAdbClient:
+    """
+    adb server 協定的 asyncio 版本 (每個服務使用一條新連線)
+    """
+    def __init__(self, serial=None, host=None, port=None):
+        self.serial = serial
+        self.host = host or adb_client.ADB_HOST
+        self.port = port or adb_client.ADB_PORT
+
+    @staticmethod
+    async def _send(reader, writer, request):
+        payload = request.encode("utf-8")
+        writer.write(b"%04x" % len(payload) + payload)
+        await writer.drain()
+        status = await reader.readexactly(4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            length = int(await reader.readexactly(4), 16)
+            message = (await reader.readexactly(length)).decode("utf-8", "ignore")
+            raise adb_client.AdbError(f"{request}: {message}")
+        raise adb_client.AdbError(f"{request}: 未知的回應 {status!r}")
+
+    async def service(self, request):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if self.serial:
+                await self._send(reader, writer, f"host:transport:{self.serial}")
+            else:
+                await self._send(reader, writer, "host:transport-any")
+            await self._send(reader, writer, request)
+            return await reader.read()
+        except asyncio.IncompleteReadError as e:
+            raise adb_client.AdbError(f"{request}: adb server 連線中斷") from e
+        finally:
+            writer.close()
+
+    async def shell(self, command):
+        return (await self.service(f"shell:{command}")).decode("utf-8", "ignore")
+
+    async def exec_out(self, command):
+        return await self.service(f"exec:{command}")
+
+
+def get_client(serial=None):
+    return AsyncAdbClient(adb_device.resolve_serial(serial))
+
+
+async def capture_screen(serial=None):
+    """
+    擷取螢幕畫面；adb server 無法連線時改在執行緒中使用同步擷取
+    """
+    serial = adb_device.resolve_serial(serial)
+    await flush_input(serial)
+    try:
+        data = await get_client(serial).exec_out("screencap")
+        screen = adb_capture.decode_raw_screencap(data)
+        if screen is not None:
+            return screen
+    except (OSError, adb_client.AdbError) as e:
+        logging.warning(f"ADB 協定連線失敗，改用同步擷取: {str(e)}")
+    return await asyncio.to_thread(adb_capture.capture_once, serial)
+
+
+async def flush_input(serial=None):
+    """
+    同步輸入佇列中若有排隊的動作，先送出
+    """
+    if adb_input.get_input_queue(serial).pending():
+        await asyncio.to_thread(adb_input.flush_input, serial)
+
+
+async def shell(command, serial=None):
+    serial = adb_device.resolve_serial(serial)
+    try:
+        return (await get_client(serial).shell(command)).strip()
+    except (OSError, adb_client.AdbError) as e:
+        logging.warning(f"ADB 協定連線失敗，改用同步命令: {str(e)}")
+        return await asyncio.to_thread(adb_input.shell, command, adb_input.COMMAND_TIMEOUT, serial)
+
+
+async def _touch_device(serial):
+    if adb_input.INPUT_BACKEND != "sendevent":
+        return None
+    return await asyncio.to_thread(adb_input.get_touch_device, serial)
+
+
+async def tap(x, y, serial=None):
+    """
+    在指定坐標點擊
+    """
+    device = await _touch_device(serial)
+    await shell(device.tap_command(x, y) if device else f"input tap {x} {y}", serial)
+    adb_capture.invalidate_frames(serial)
+    logging.info(f"點擊坐標: ({x}, {y})")
+
+
+async def swipe(x1, y1, x2, y2, duration=500, serial=None):
+    """
+    從一個坐標滑動到另一個坐標
+    """
+    device = await _touch_device(serial)
+    command = device.swipe_command(x1, y1, x2, y2, duration) if device else f"input swipe {x1} {y1} {x2} {y2} {duration}"
+    await shell(command, serial)
+    adb_capture.invalidate_frames(serial)
+    logging.info(f"滑動: 從 ({x1}, {y1}) 到 ({x2}, {y2})")
+
+
+async def check_image(image_path, region=None, serial=None):
+    """
+    擷取一次畫面並檢測圖像是否存在
+    """
+    if template_store.load_template(image_path) is None:
+        logging.error(f"文件不存在: {image_path}")
+        return False, None, None
+    screen = await capture_screen(serial)
+    if screen is None:
+        logging.error("無法捕獲螢幕畫面")
+        return False, None, None
+    # matchTemplate 會釋放 GIL，放到執行緒中以免阻塞事件迴圈
+    # 執行緒沒有綁定裝置，serial 需明確傳入，快速檢查的快取才會依裝置分開
+    match = await asyncio.to_thread(matcher.match_path, screen, image_path, region, serial=serial)
+    if match.found:
+        return True, match.location, match.shape
+    return False, None, None
+
+
+async def wait_for_image(image_path, region=None, timeout=10, interval=POLL_INTERVAL, serial=None):
+    """
+    等待圖像出現，回傳 (是否找到, 左上角座標, 模板大小)；逾時回傳未找到
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        found, location, shape = await check_image(image_path, region, serial)
+        if found:
+            return found, location, shape
+        if time.monotonic() >= deadline:
+            logging.error(f"在 {timeout} 秒內未找到圖像: {image_path}")
+            return False, None, None
+        await asyncio.sleep(interval)
+
+
+async def find_and_click_image(image_path, timeout=10, delay=0.1, region=None, serial=None):
+    """
+    等待圖像出現並點擊其中心
+    """
+    found, location, shape = await wait_for_image(image_path, region, timeout, serial=serial)
+    if not found:
+        return False
+    center_x = location[0] + shape[1] // 2
+    center_y = location[1] + shape[0] // 2
+    await tap(center_x, center_y, serial)
+    logging.info(f"找到並點擊了圖像: {image_path} at {center_x}, {center_y}")
+    await asyncio.sleep(delay)
+    return True
+
+
+async def click_until_next_image(click_coords, next_image_path, timeout=100, delay=2, region=None, serial=None):
+    """
+    持續點擊指定坐標，直到能夠檢測到下一張圖片
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await tap(click_coords[0], click_coords[1], serial)
+        found, _, _ = await check_image(next_image_path, region, serial)
+        if found:
+            logging.info(f"檢測到下一張圖片: {next_image_path}")
+            return True
+        await asyncio.sleep(delay)
+    logging.error(f"在 {timeout} 秒內仍未檢測到下一張圖片。")
+    return False
+
+
+async def run_on_devices(flow, serials=None):
+    """
+    在同一個事件迴圈中對多台裝置同時執行 flow(serial)，回傳 {serial: 結果}
+    """
+    serials = serials or await asyncio.to_thread(adb_client.list_devices)
+    results = await asyncio.gather(*(flow(serial) for serial in serials), return_exceptions=True)
+    return dict(zip(serials, results))
+
+
+# 同步包裝
+def wait_for_image_sync(image_path, region=None, timeout=10, interval=POLL_INTERVAL, serial=None):
+    return asyncio.run(wait_for_image(image_path, region, timeout, interval, serial))
+
+
+def find_and_click_image_sync(image_path, timeout=10, delay=0.1, region=None, serial=None):
+    return asyncio.run(find_and_click_image(image_path, timeout, delay, region, serial))
+
+
+def click_until_next_image_sync(click_coords, next_image_path, timeout=100, delay=2, region=None, serial=None):
+    return asyncio.run(click_until_next_image(click_coords, next_image_path, timeout, delay, region, serial))
@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+import cv2
+import numpy as np
+import template_store
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+"""
+    數字辨識
+    遊戲數字使用固定字型，以字形模板 (photoForStar_Rail/digits/ 內的 0.png ~ 9.png、slash.png) 辨識:
+    二值化 -> 以連通區域切出每個字 -> 縮放成固定大小 -> 一次矩陣乘法算出與所有字形的相關係數
+    字形模板須包含 0~9 全部數字才會使用，否則缺少的數字會被誤認成相近的字形；
+    模板不完整或無法可靠辨識 (分數過低、寬高比與字形不符) 時改用 pytesseract (若有安裝)
+    read_number() 的結果以截圖像素的雜湊做 LRU 快取，數字沒變時直接回傳上次的結果
+    digit_samples/ 為錄下的遊戲數字截圖與正確文字 (labels.json)，python digit_ocr.py digit_samples/*.png 檢查正確率
+"""
+GLYPH_DIR = os.path.join(template_store.BASE_DIR, "photoForStar_Rail", "digits")
+GLYPH_SIZE = (12, 16)  # 字形正規化大小 (寬, 高)
+MIN_SCORE = 0.75  # 每個字的最低相關係數，低於此值視為無法辨識
+MAX_ASPECT_RATIO = 1.4  # 切出的字與最相似字形的寬高比相差超過此倍數 (例如黏在一起的兩個字) 視為無法辨識
+MIN_GLYPH_PIXELS = 4  # 前景像素少於此值的區塊視為雜訊
+MAX_HEIGHT_RATIO = 1.5  # 高度超過中位數此倍數的區塊 (例如數字旁的圖示) 不視為文字
+LINE_ASPECT = 4  # 寬度超過高度此倍數的區塊 (底線、分隔線) 不視為文字
+DIGITS = "0123456789"
+TESSERACT_FALLBACK = True
+TESSERACT_CONFIG = '--psm 6 digits'
+
+OCR_CACHE_SIZE = 64  # 快取的截圖數量，0 表示不快取
+
+# 檔名與字元的對應 (檔名不能包含 "/")
+GLYPH_NAMES = {"slash": "/", "colon": ":", "dot": "."}
+
+_glyphs = None
+_glyphs_lock = threading.Lock()
+_cache = OrderedDict()  # {像素雜湊: 辨識結果}
+_cache_lock = threading.Lock()
+cache_hits = 0
+cache_misses = 0
+
+
+def binarize(image):
+    """
+    灰階 + Otsu 二值化，輸出前景 (文字) 為 255
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # 以邊框像素判斷背景: 邊框多為白色表示文字是深色，反轉
+    border = np.concatenate((binary[0], binary[-1], binary[:, 0], binary[:, -1]))
+    if np.count_nonzero(border) > border.size // 2:
+        binary = cv2.bitwise_not(binary)
+    return binary
+
+
+def segment(binary):
+    """
+    以連通區域切出每個字，回傳由左到右的字形影像
+    水平範圍重疊的區域 (例如冒號的兩點) 合併為同一個字；底線等細長區域與高度不符的區域 (圖示) 略過
+    """
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    boxes = []  # [左, 右, 上, 下, [區域編號]]
+    for index in sorted(range(1, count), key=lambda i: stats[i, cv2.CC_STAT_LEFT]):
+        left, top, width, height, area = stats[index]
+        if area < MIN_GLYPH_PIXELS or width > height * LINE_ASPECT:
+            continue
+        if boxes and left < boxes[-1][1]:
+            box = boxes[-1]
+            box[1], box[2], box[3] = max(box[1], left + width), min(box[2], top), max(box[3], top + height)
+            box[4].append(index)
+        else:
+            boxes.append([left, left + width, top, top + height, [index]])
+    if len(boxes) > 1:
+        limit = np.median([box[3] - box[2] for box in boxes]) * MAX_HEIGHT_RATIO
+        boxes = [box for box in boxes if box[3] - box[2] <= limit]
+    glyphs = []
+    for left, right, top, bottom, members in boxes:
+        # 只保留屬於這個字的像素，其他區域伸進範圍內的部分不算
+        mask = np.isin(labels[top:bottom, left:right], members)
+        glyphs.append(np.where(mask, 255, 0).astype(np.uint8))
+    return glyphs
+
+
+def glyph_vectors(glyphs):
+    """
+    將字形縮放成固定大小並正規化 (零平均、單位長度)，回傳 (字數, 維度) 矩陣
+    """
+    vectors = np.empty((len(glyphs), GLYPH_SIZE[0] * GLYPH_SIZE[1]), np.float32)
+    for i, glyph in enumerate(glyphs):
+        vectors[i] = cv2.resize(glyph, GLYPH_SIZE, interpolation=cv2.INTER_AREA).ravel()
+    vectors -= vectors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class GlyphBank:
+    """
+    已知字形的向量矩陣與對應字元
+    """
+    def __init__(self, labels, vectors, aspects=None):
+        self.labels = labels
+        self.vectors = vectors
+        self.aspects = np.asarray(aspects if aspects is not None else [], np.float32)  # 每個字形的寬 / 高
+
+    @classmethod
+    def load(cls, glyph_dir=None):
+        glyph_dir = glyph_dir or GLYPH_DIR
+        labels, glyphs = [], []
+        if os.path.isdir(glyph_dir):
+            for name in sorted(os.listdir(glyph_dir)):
+                stem, ext = os.path.splitext(name)
+                if ext.lower() != ".png":
+                    continue
+                image = cv2.imread(os.path.join(glyph_dir, name), cv2.IMREAD_GRAYSCALE)
+                if image is None:
+                    continue
+                pieces = segment(binarize(image))
+                if len(pieces) != 1:
+                    logging.warning(f"字形模板應只包含一個字: {name}")
+                    continue
+                # 同一字元可以有多個模板，例如 4.png、4_1.png
+                labels.append(GLYPH_NAMES.get(stem.split("_")[0], stem.split("_")[0]))
+                glyphs.append(pieces[0])
+        vectors = glyph_vectors(glyphs) if glyphs else np.empty((0, GLYPH_SIZE[0] * GLYPH_SIZE[1]), np.float32)
+        return cls(labels, vectors, [glyph.shape[1] / glyph.shape[0] for glyph in glyphs])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def missing(self):
+        """
+        字形模板中缺少的數字
+        """
+        return "".join(digit for digit in DIGITS if digit not in self.labels)
+
+    def complete(self):
+        return not self.missing()
+
+    def recognize(self, image):
+        """
+        回傳 (文字, 最低的單字分數)；沒有字形、有任一字分數過低或寬高比與字形不符時文字為 None
+        """
+        if not len(self):
+            return None, 0.0
+        pieces = segment(binarize(image))
+        if not pieces:
+            return None, 0.0
+        scores = glyph_vectors(pieces) @ self.vectors.T
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(pieces)), best]
+        worst = float(best_scores.min())
+        if worst < MIN_SCORE:
+            return None, worst
+        if len(self.aspects):
+            aspects = np.array([piece.shape[1] / piece.shape[0] for piece in pieces], np.float32)
+            ratios = aspects / self.aspects[best]
+            if np.any(np.maximum(ratios, 1 / ratios) > MAX_ASPECT_RATIO):
+                return None, worst
+        return "".join(self.labels[i] for i in best), worst
+
+
+def get_glyphs():
+    global _glyphs
+    with _glyphs_lock:
+        if _glyphs is None:
+            _glyphs = GlyphBank.load()
+            if not len(_glyphs):
+                logging.warning(f"沒有字形模板 ({GLYPH_DIR})，數字辨識將使用 pytesseract")
+            elif not _glyphs.complete():
+                logging.warning(f"字形模板缺少數字 {_glyphs.missing()}，數字辨識將使用 pytesseract")
+    return _glyphs
+
+
+def tesseract(image):
+    if pytesseract is None:
+        return None
+    try:
+        return pytesseract.image_to_string(image, config=TESSERACT_CONFIG).strip()
+    except OSError as e:
+        # 有安裝 pytesseract 但找不到 tesseract 執行檔
+        logging.warning(f"無法執行 tesseract: {str(e)}")
+        return None
+
+
+def pixel_hash(image):
+    """
+    截圖像素的雜湊 (包含大小)；有安裝 xxhash 時使用 xxh3，否則使用 blake2b
+    """
+    data = np.ascontiguousarray(image)
+    if xxhash is not None:
+        digest = xxhash.xxh3_64_digest(data)
+    else:
+        digest = hashlib.blake2b(data, digest_size=8).digest()
+    return data.shape, digest
+
+
+def set_cache_size(size):
+    """
+    設定快取大小並移除超出的舊項目
+    """
+    global OCR_CACHE_SIZE
+    with _cache_lock:
+        OCR_CACHE_SIZE = size
+        while len(_cache) > max(size, 0):
+            _cache.popitem(last=False)
+
+
+def clear_cache():
+    global cache_hits, cache_misses
+    with _cache_lock:
+        _cache.clear()
+        cache_hits = cache_misses = 0
+
+
+def cache_stats():
+    """
+    回傳 (命中, 未命中, 目前項目數, 大小上限)
+    """
+    with _cache_lock:
+        return cache_hits, cache_misses, len(_cache), OCR_CACHE_SIZE
+
+
+def _recognize(image):
+    bank = get_glyphs()
+    text = bank.recognize(image)[0] if bank.complete() else None
+    if text is None and TESSERACT_FALLBACK:
+        text = tesseract(image)
+    return text
+
+
+def read_number(image):
+    """
+    辨識影像中的數字文字，字形模板不完整或無法辨識時改用 pytesseract；都無法辨識時回傳 None
+    像素與先前某次完全相同時直接回傳快取的結果
+    """
+    global cache_hits, cache_misses
+    if OCR_CACHE_SIZE <= 0:
+        return _recognize(image)
+    key = pixel_hash(image)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            cache_hits += 1
+            return _cache[key]
+        cache_misses += 1
+    text = _recognize(image)
+    with _cache_lock:
+        _cache[key] = text
+        _cache.move_to_end(key)
+        while len(_cache) > OCR_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return text
+
+
+def learn(image, text, glyph_dir=None):
+    """
+    以已知文字的截圖建立字形模板: 切出的字數須與文字長度相同，已存在的字元不覆蓋
+    """
+    global _glyphs
+    glyph_dir = glyph_dir or GLYPH_DIR
+    pieces = segment(binarize(image))
+    if len(pieces) != len(text):
+        logging.error(f"切出 {len(pieces)} 個字，與文字 \"{text}\" 的長度不符")
+        return False
+    names = {char: name for name, char in GLYPH_NAMES.items()}
+    os.makedirs(glyph_dir, exist_ok=True)
+    for char, piece in zip(text, pieces):
+        path = os.path.join(glyph_dir, f"{names.get(char, char)}.png")
+        if not os.path.exists(path):
+            # 四周留 1 像素空白，讀回時可以切出同樣的字
+            cv2.imwrite(path, cv2.copyMakeBorder(piece, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0))
+            logging.info(f"已新增字形: {char} -> {path}")
+    with _glyphs_lock:
+        _glyphs = None
+    return True
+
+
+def load_labels(crop_paths):
+    """
+    讀取截圖資料夾中的 labels.json ({檔名: 正確文字})，沒有時回傳空字典
+    """
+    labels = {}
+    for folder in sorted({os.path.dirname(path) for path in crop_paths}):
+        try:
+            with open(os.path.join(folder, "labels.json"), encoding="utf-8") as f:
+                labels.update({os.path.join(folder, name): text for name, text in json.load(f).items()})
+        except (OSError, ValueError):
+            pass
+    return labels
+
+
+def compare_with_tesseract(crop_paths, labels=None):
+    """
+    以錄下的數字截圖比較字形辨識與 tesseract 的結果與耗時；有正確文字 (labels) 時一併計算兩者的正確率
+    """
+    bank = get_glyphs()
+    labels = load_labels(crop_paths) if labels is None else labels
+    agree = total = 0
+    glyph_correct = tesseract_correct = labelled = 0
+    glyph_time = tesseract_time = 0.0
+    for path in crop_paths:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"無法讀取圖片: {path}")
+            continue
+        start = time.perf_counter()
+        text, score = bank.recognize(image)
+        glyph_time += time.perf_counter() - start
+        start = time.perf_counter()
+        expected = tesseract(image)
+        tesseract_time += time.perf_counter() - start
+        total += 1
+        agree += text == expected
+        truth = labels.get(path)
+        if truth is not None:
+            labelled += 1
+            glyph_correct += text == truth
+            tesseract_correct += expected == truth
+        print(f"{path}: 字形 {text} ({score:.2f})，tesseract {expected}，正確 {truth}")
+    if total:
+        print(f"一致 {agree}/{total}")
+        if labelled:
+            print(f"正確率: 字形 {glyph_correct}/{labelled}，tesseract {tesseract_correct}/{labelled}"
+                  f"{'' if pytesseract is not None else ' (未安裝 pytesseract)'}")
+        print(f"字形 {glyph_time / total * 1000:.3f} ms/次，tesseract {tesseract_time / total * 1000:.1f} ms/次")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if len(sys.argv) == 4 and sys.argv[1] == "learn":
+        # python digit_ocr.py learn <截圖.png> <截圖中的文字>
+        learn(cv2.imread(sys.argv[2]), sys.argv[3])
+    else:
+        # python digit_ocr.py <截圖.png ...>
+        compare_with_tesseract(sys.argv[1:])
@@ -0,0 +1,105 @@
+import socketserver
+import threading
+import logging
+
+"""
+    測試用的假 adb server
+    只實作 adb_client 用到的最小協定: host:version、host:devices、
+    host:transport:<serial>/host:transport-any 以及之後的 shell:/exec: 服務
+    會記錄連線數與收到的請求，方便檢查連線池是否真的重複使用連線
+"""
+FAKE_VERSION = 0x29
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def _read_request(self):
+        header = self._recv(4)
+        if not header:
+            return None
+        return self._recv(int(header, 16)).decode("utf-8")
+
+    def _recv(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return data
+            data += chunk
+        return data
+
+    def _okay(self, payload=None):
+        self.request.sendall(b"OKAY")
+        if payload is not None:
+            data = payload.encode("utf-8")
+            self.request.sendall(b"%04x" % len(data) + data)
+
+    def _fail(self, message):
+        data = message.encode("utf-8")
+        self.request.sendall(b"FAIL" + b"%04x" % len(data) + data)
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        transport = None
+        while True:
+            request = self._read_request()
+            if not request:
+                return
+            with server.lock:
+                server.requests.append(request)
+            if request == "host:version":
+                self._okay("%04x" % FAKE_VERSION)
+                return
+            if request == "host:devices":
+                self._okay("".join(f"{serial}\tdevice\n" for serial in server.devices))
+                return
+            if transport is None and request.startswith("host:transport"):
+                if request == "host:transport-any" and server.devices:
+                    transport = server.devices[0]
+                else:
+                    transport = request[len("host:transport:"):]
+                if transport not in server.devices:
+                    self._fail(f"device '{transport}' not found")
+                    return
+                self._okay()
+                continue
+            if transport is not None and request.startswith(("shell:", "exec:")):
+                command = request.split(":", 1)[1]
+                self._okay()
+                self.request.sendall(server.outputs.get(command, b""))
+                return
+            self._fail(f"unknown request: {request}")
+            return
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    """
+    在 127.0.0.1 的隨機埠啟動假 adb server
+    devices: 已連線的裝置 serial 列表；outputs: 命令 -> 輸出 (bytes)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, devices=("emulator-5554",), outputs=None):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.devices = list(devices)
+        self.outputs = dict(outputs or {})
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        logging.info(f"假 adb server 已啟動於埠 {self.port}")
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
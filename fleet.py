@@ -0,0 +1,99 @@
+import threading
+import datetime
+import logging
+import keyboard
+import adb_client
+import adb_device
+import adb_input
+import Ld_noUI
+
+"""
+    多裝置執行器: 同時在每一台已連接的雷電模擬器上執行 Ld_noUI 的周回流程
+    每台裝置有自己的工作線程與 keep_running 控制
+"""
+# 設置日誌記錄
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(threadName)s - %(levelname)s - %(message)s")
+
+
+class DeviceWorker(threading.Thread):
+    """
+    單一裝置的工作線程
+    """
+    def __init__(self, serial, target):
+        super().__init__(name=f"device-{serial}", daemon=True)
+        self.serial = serial
+        self.target = target
+        self.keep_running = True
+        self.error = None
+
+    def stop(self):
+        self.keep_running = False
+
+    def run(self):
+        # 綁定裝置後，adb_client / adb_capture / adb_input 的呼叫都會指向這台裝置
+        adb_device.use_device(self.serial, self)
+        logging.info(f"裝置 {self.serial} 開始執行")
+        try:
+            self.target()
+        except Exception as e:
+            self.error = e
+            logging.error(f"裝置 {self.serial} 執行出錯: {str(e)}")
+        finally:
+            adb_input.flush_input(self.serial)
+            logging.info(f"裝置 {self.serial} 結束執行")
+
+
+class FleetRunner:
+    """
+    為每台裝置建立一個 DeviceWorker，並提供個別或全部停止
+    """
+    def __init__(self, target=Ld_noUI.farming_loop, serials=None):
+        self.target = target
+        self.serials = serials
+        self.workers = {}
+
+    def start(self):
+        adb_client.start_server()
+        serials = self.serials or adb_client.list_devices()
+        if not serials:
+            logging.error("未檢測到已連接的設備，請確保模擬器已啟動並已連接。")
+            return False
+        for serial in serials:
+            worker = DeviceWorker(serial, self.target)
+            self.workers[serial] = worker
+            worker.start()
+        logging.info(f"已在 {len(serials)} 台裝置上啟動: {', '.join(serials)}")
+        return True
+
+    def stop(self, serial=None):
+        """
+        停止指定裝置，未指定時停止全部
+        """
+        if serial is not None:
+            self.workers[serial].stop()
+            return
+        for worker in self.workers.values():
+            worker.stop()
+
+    def join(self):
+        for worker in self.workers.values():
+            worker.join()
+
+    def running(self):
+        return [serial for serial, worker in self.workers.items() if worker.is_alive()]
+
+
+def main():
+    runner = FleetRunner()
+    keyboard.add_hotkey('`', runner.stop)
+    logging.info("已設置按下 '`' 鍵以停止所有裝置。")
+
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    logging.info(f"--- 程序開始執行 {current_time} ---")
+    if runner.start():
+        runner.join()
+    logging.info(f"--- 程序執行結束 {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+
+
+if __name__ == "__main__":
+    main()
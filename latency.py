@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import atexit
+import threading
+import logging
+from collections import deque
+import numpy as np
+import adb_input
+import template_store
+import waits
+
+"""
+    轉場延遲模型
+    記錄每個 (動作, 下一張圖片) 轉場實際花費的秒數，保留最近 WINDOW 筆並存於 .template_cache/latency.json
+    動作之後的第一次擷取排在預期的 p50 附近，取代寫死的 sleep
+    批次輸入 (adb_input.BATCH_INPUT) 時動作可能仍在佇列中: 先送出再開始計時，否則等待會延後動作本身，
+    量到的延遲也會包含這段等待
+"""
+LATENCY_PATH = os.path.join(template_store.CACHE_DIR, "latency.json")
+WINDOW = 50  # 每個轉場保留的樣本數
+MIN_SAMPLES = 3  # 樣本數少於此值時使用呼叫端給的預設值
+SCHEDULE_FACTOR = 0.9  # 第一次擷取排在 p50 * 此值，略早於中位數
+SAVE_INTERVAL = 10  # 有新樣本時最多每隔幾秒寫入一次檔案
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def transition_key(action, target):
+    return f"{action} -> {os.path.basename(target)}"
+
+
+class LatencyModel:
+    """
+    每個轉場最近 WINDOW 筆延遲 (秒)
+    """
+    def __init__(self, path=None):
+        self.path = path or LATENCY_PATH
+        self.samples = {key: deque(values, maxlen=WINDOW) for key, values in self._read().items()}
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def record(self, action, target, seconds):
+        key = transition_key(action, target)
+        with self._lock:
+            self.samples.setdefault(key, deque(maxlen=WINDOW)).append(round(seconds, 3))
+            self._dirty = True
+            save = time.monotonic() - self._last_save >= SAVE_INTERVAL
+        if save:
+            self.save()
+
+    def percentile(self, action, target, q=50):
+        """
+        回傳延遲的第 q 百分位數；樣本不足時回傳 None
+        """
+        with self._lock:
+            values = list(self.samples.get(transition_key(action, target), ()))
+        if len(values) < MIN_SAMPLES:
+            return None
+        return float(np.percentile(values, q))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {key: list(values) for key, values in self.samples.items()}
+            self._dirty = False
+            self._last_save = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+        except OSError as e:
+            logging.warning(f"無法寫入延遲模型: {str(e)}")
+
+    def summary(self):
+        """
+        {轉場: (樣本數, p50, p90)}
+        """
+        with self._lock:
+            items = {key: list(values) for key, values in self.samples.items()}
+        return {key: (len(values), float(np.percentile(values, 50)), float(np.percentile(values, 90)))
+                for key, values in items.items() if values}
+
+
+def get_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = LatencyModel()
+            atexit.register(_model.save)
+    return _model
+
+
+def expected(action, target, default=0.0):
+    """
+    預期的轉場延遲 (p50)；樣本不足時為 default
+    """
+    p50 = get_model().percentile(action, target)
+    return default if p50 is None else p50
+
+
+def mark_sent(since=None, serial=None):
+    """
+    送出排隊中的輸入，回傳動作實際送到裝置的時間 (不早於 since)
+    """
+    adb_input.flush_input(serial)
+    now = time.monotonic()
+    return now if since is None else max(since, now)
+
+
+def settle(action, targets, since, default=0.0, serial=None):
+    """
+    先送出排隊中的輸入，再睡到預期最早出現的時間點 (p50 * SCHEDULE_FACTOR)；回傳實際的計時起點
+    """
+    since = mark_sent(since, serial)
+    delays = [expected(action, target, default) for target in targets]
+    delay = min(delays) * SCHEDULE_FACTOR if delays else 0.0
+    remaining = since + delay - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+    return since
+
+
+def observe(action, target, since):
+    """
+    記錄一次轉場: 從 since (動作完成) 到偵測到 target 的秒數
+    """
+    get_model().record(action, target, time.monotonic() - since)
+
+
+def wait_for_image(action, image_path, region=None, timeout=10, since=None, default=0.0, serial=None,
+                   should_continue=None):
+    """
+    在動作之後等待圖像: 先睡到預期的延遲附近再開始擷取，找到時記錄這次的延遲；回傳 matcher.Match
+    since 為動作完成的時間 (time.monotonic())；None 表示沒有對應的動作，直接等待且不記錄
+    """
+    if since is None:
+        return waits.wait_for_image(image_path, region, timeout, serial, should_continue)
+    since = settle(action, [image_path], since, default, serial)
+    remaining = max(0.0, since + timeout - time.monotonic())
+    match = waits.wait_for_image(image_path, region, remaining, serial, should_continue)
+    if match.found:
+        observe(action, image_path, since)
+    return match
+
+
+def wait_any(action, targets, timeout=10, since=None, default=0.0, serial=None, should_continue=None):
+    """
+    wait_any 的延遲排程版本，回傳 (名稱, matcher.Match)；since 的意義與 wait_for_image 相同
+    """
+    if since is None:
+        return waits.wait_any(targets, timeout, serial, should_continue)
+    paths = {name: target[0] if isinstance(target, tuple) else target for name, target in targets.items()}
+    since = settle(action, list(paths.values()), since, default, serial)
+    remaining = max(0.0, since + timeout - time.monotonic())
+    name, match = waits.wait_any(targets, remaining, serial, should_continue)
+    if name is not None:
+        observe(action, paths[name], since)
+    return name, match
+
+
+if __name__ == "__main__":
+    # python latency.py: 列出每個轉場的樣本數與百分位數
+    summary = get_model().summary()
+    if not summary:
+        print("尚無轉場延遲紀錄")
+    for key, (count, p50, p90) in sorted(summary.items()):
+        print(f"{key}: {count} 筆，p50 {p50:.2f} 秒，p90 {p90:.2f} 秒")
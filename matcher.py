@@ -0,0 +1,554 @@
+import os
+import sys
+import json
+import time
+import zlib
+import atexit
+import threading
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import adb_device
+import template_store
+
+"""
+    模板匹配
+    match_jobs() / match_all() 以同一幀一次比對多個 (模板, 範圍)；cv2.matchTemplate 執行時會釋放 GIL，因此以線程池平行處理
+    金字塔模式: 先在縮小的畫面上找出候選位置，再只在候選位置附近以全解析度精修
+    位置提示: 記住每個模板上次出現的位置 (存於 .template_cache/roi_hints.json)，全畫面搜尋時先搜尋該位置附近
+    雜湊快速檢查: 搜尋範圍的像素 (CRC32) 與上一次完全相同且上一次未找到時，直接判定未找到，不執行 matchTemplate
+    (縮小後的感知雜湊無法察覺小按鈕出現，因此只接受完全相同的畫面)
+"""
+MATCH_THRESHOLD = 0.8
+MATCH_WORKERS = None  # 比對線程池大小，None 為 CPU 核心數
+
+# 金字塔比對設定
+PYRAMID_MATCH = True
+PYRAMID_SCALE = 2  # 縮小倍數，需為 template_store.SCALES 之一
+PYRAMID_MARGIN = 8  # 精修窗口在模板四周多留的像素 (全解析度)
+PYRAMID_CANDIDATES = 3  # 最多精修幾個候選位置
+PYRAMID_COARSE_SLACK = 0.15  # 縮小後分數會降低，候選門檻 = 門檻 - 此值
+PYRAMID_MIN_SIZE = 8  # 縮小後的模板短邊小於此值時改用全解析度
+# 個別模板的設定 {檔名: {"scale": 4, "margin": 12}}；scale 為 1 表示此模板不使用金字塔
+PYRAMID_OVERRIDES = {}
+
+# 位置提示設定
+ROI_HINTS = True
+HINT_MARGIN = 40  # 在上次位置四周多搜尋的像素
+HINT_SAVE_INTERVAL = 10  # 位置有變動時，最多每隔幾秒寫入一次檔案
+HINTS_PATH = os.path.join(template_store.CACHE_DIR, "roi_hints.json")
+
+# 雜湊快速檢查設定
+HASH_FASTPATH = True
+HASH_MAX_SKIPS = 5  # 連續略過此次數後強制比對一次
+
+# 單一模板的比對結果: 路徑、是否找到、分數、左上角座標 (整個畫面)、模板大小
+Match = namedtuple("Match", ["path", "found", "score", "location", "shape"])
+
+_executor = None
+_executor_lock = threading.Lock()
+_scaled_frames = {}  # {縮小倍數: (原畫面, 縮小後畫面)}，同一幀的多次比對共用縮小結果
+_scaled_lock = threading.Lock()
+_hints = None
+_hints_lock = threading.Lock()
+_negative_hashes = {}  # {(模板, 範圍, serial): [搜尋範圍的雜湊, 連續略過次數]}，只保存未找到的結果
+_skip_counts = {}  # {模板: 略過次數}
+_fastpath_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = MATCH_WORKERS or os.cpu_count() or 4
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="match")
+    return _executor
+
+
+def set_workers(workers):
+    """
+    變更比對線程池大小 (None 為 CPU 核心數)，下一次比對時以新的大小建立
+    """
+    global MATCH_WORKERS, _executor
+    with _executor_lock:
+        MATCH_WORKERS = workers
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def best_match(screen, template, region=None):
+    """
+    回傳 (最高分數, 左上角座標)；座標已換算回整個畫面
+    """
+    if region:
+        x, y, w, h = region
+        screen = screen[y:y + h, x:x + w]
+    if screen.shape[0] < template.shape[0] or screen.shape[1] < template.shape[1]:
+        return -1.0, None
+    result = cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, max_loc = cv2.minMaxLoc(result)
+    if region:
+        max_loc = (max_loc[0] + x, max_loc[1] + y)
+    return max_val, max_loc
+
+
+def pyramid_settings(image_path):
+    """
+    回傳模板的 (縮小倍數, 精修邊距)；不使用金字塔時倍數為 1
+    """
+    if not PYRAMID_MATCH:
+        return 1, 0
+    override = PYRAMID_OVERRIDES.get(os.path.basename(image_path), {})
+    return override.get("scale", PYRAMID_SCALE), override.get("margin", PYRAMID_MARGIN)
+
+
+def set_pyramid(image_name, scale=None, margin=None):
+    """
+    設定個別模板的金字塔參數
+    """
+    override = PYRAMID_OVERRIDES.setdefault(os.path.basename(image_name), {})
+    if scale is not None:
+        override["scale"] = scale
+    if margin is not None:
+        override["margin"] = margin
+
+
+def downscale_frame(screen, scale):
+    """
+    縮小整個畫面；保留最近一幀的結果，同一幀比對多個模板時只縮小一次
+    """
+    with _scaled_lock:
+        cached = _scaled_frames.get(scale)
+        if cached is not None and cached[0] is screen:
+            return cached[1]
+    size = (screen.shape[1] // scale, screen.shape[0] // scale)
+    scaled = cv2.resize(screen, size, interpolation=cv2.INTER_AREA)
+    with _scaled_lock:
+        _scaled_frames[scale] = (screen, scaled)
+    return scaled
+
+
+def _coarse_template(template, scale):
+    coarse = template.scaled.get(scale)
+    if coarse is None:
+        size = (max(1, template.image.shape[1] // scale), max(1, template.image.shape[0] // scale))
+        coarse = cv2.resize(template.image, size, interpolation=cv2.INTER_AREA)
+    return coarse
+
+
+def pyramid_match(screen, template, scale, margin, region=None, threshold=MATCH_THRESHOLD):
+    """
+    金字塔比對，回傳 (最高分數, 左上角座標)
+    先以縮小後的畫面找出最多 PYRAMID_CANDIDATES 個候選，再於每個候選附近的小窗口以全解析度比對
+    """
+    image = template.image
+    coarse = _coarse_template(template, scale)
+    if min(coarse.shape[:2]) < PYRAMID_MIN_SIZE:
+        return best_match(screen, image, region)
+
+    if region:
+        x, y, w, h = region
+        frame = screen[y:y + h, x:x + w]
+        if frame.shape[0] < image.shape[0] or frame.shape[1] < image.shape[1]:
+            return -1.0, None
+        small = cv2.resize(frame, (frame.shape[1] // scale, frame.shape[0] // scale), interpolation=cv2.INTER_AREA)
+    else:
+        x, y = 0, 0
+        frame = screen
+        small = downscale_frame(screen, scale)
+    if small.shape[0] < coarse.shape[0] or small.shape[1] < coarse.shape[1]:
+        return best_match(screen, image, region)
+
+    result = cv2.matchTemplate(small, coarse, cv2.TM_CCOEFF_NORMED)
+    best_val, best_loc = -1.0, None
+    coarse_threshold = threshold - PYRAMID_COARSE_SLACK
+    template_h, template_w = image.shape[:2]
+    for _ in range(PYRAMID_CANDIDATES):
+        _, peak, _, peak_loc = cv2.minMaxLoc(result)
+        if peak < coarse_threshold:
+            if best_loc is None:
+                best_val = max(best_val, peak)
+            break
+        # 清除此峰值附近，下一輪找其他候選
+        px, py = peak_loc
+        result[max(0, py - coarse.shape[0] // 2):py + coarse.shape[0] // 2 + 1,
+               max(0, px - coarse.shape[1] // 2):px + coarse.shape[1] // 2 + 1] = -1.0
+
+        left = max(0, px * scale - margin)
+        top = max(0, py * scale - margin)
+        right = min(frame.shape[1], px * scale + template_w + margin)
+        bottom = min(frame.shape[0], py * scale + template_h + margin)
+        if right - left < template_w or bottom - top < template_h:
+            continue
+        window = cv2.matchTemplate(frame[top:bottom, left:right], image, cv2.TM_CCOEFF_NORMED)
+        _, val, _, loc = cv2.minMaxLoc(window)
+        if val > best_val:
+            best_val, best_loc = val, (left + loc[0] + x, top + loc[1] + y)
+        if best_val >= threshold:
+            break
+    return best_val, best_loc
+
+
+def find_template(screen, template, region=None, threshold=MATCH_THRESHOLD):
+    """
+    以模板的金字塔設定比對 template_store.Template，回傳 (最高分數, 左上角座標)
+    """
+    scale, margin = pyramid_settings(template.path)
+    if scale <= 1:
+        return best_match(screen, template.image, region)
+    return pyramid_match(screen, template, scale, margin, region, threshold)
+
+
+def match_template(screen, template, region=None, threshold=MATCH_THRESHOLD):
+    """
+    在畫面 (或指定範圍) 中尋找模板，回傳 (是否找到, 左上角座標, 模板大小)
+    """
+    score, location = best_match(screen, template, region)
+    if score >= threshold:
+        return True, location, template.shape
+    return False, None, None
+
+
+class RegionHints:
+    """
+    每個模板上次被找到的位置與提示命中統計，以 JSON 保存
+    hits: 在上次位置附近找到；misses: 上次位置附近沒有，全畫面搜尋在別處找到；scans: 沒有提示時的全畫面搜尋
+    """
+    def __init__(self, path=None, margin=None):
+        self.path = path or HINTS_PATH
+        self.margin = HINT_MARGIN if margin is None else margin
+        self.entries = self._read()
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(template):
+        base = os.path.normcase(template_store.BASE_DIR)
+        if template.path.startswith(base):
+            return os.path.relpath(template.path, base).replace(os.sep, "/")
+        return template.path
+
+    def _entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {"location": None, "hits": 0, "misses": 0, "scans": 0}
+        return entry
+
+    def region(self, template, screen_shape):
+        """
+        回傳上次位置附近的搜尋範圍 (x, y, w, h)，沒有提示時為 None
+        """
+        entry = self.entries.get(self.key(template))
+        if not entry or not entry["location"]:
+            return None
+        x, y = entry["location"]
+        h, w = template.shape[:2]
+        left = max(0, x - self.margin)
+        top = max(0, y - self.margin)
+        right = min(screen_shape[1], x + w + self.margin)
+        bottom = min(screen_shape[0], y + h + self.margin)
+        if right - left < w or bottom - top < h:
+            return None
+        return left, top, right - left, bottom - top
+
+    def record(self, template, outcome, location=None):
+        """
+        outcome 為 "hits" / "misses" / "scans"；location 為這次找到的位置
+        """
+        with self._lock:
+            entry = self._entry(self.key(template))
+            entry[outcome] += 1
+            if location is not None and entry["location"] != list(location):
+                entry["location"] = list(location)
+                self._dirty = True
+            save = self._dirty and time.monotonic() - self._last_save >= HINT_SAVE_INTERVAL
+        if save:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            entries = json.loads(json.dumps(self.entries))
+            self._dirty = False
+            self._last_save = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False, indent=1)
+        except OSError as e:
+            logging.warning(f"無法寫入位置提示: {str(e)}")
+
+    def stats(self):
+        """
+        {模板: (命中, 未命中, 全畫面搜尋, 命中率)}
+        """
+        result = {}
+        for key, entry in self.entries.items():
+            tried = entry["hits"] + entry["misses"]
+            result[key] = (entry["hits"], entry["misses"], entry["scans"], entry["hits"] / tried if tried else 0.0)
+        return result
+
+
+def get_hints():
+    global _hints
+    with _hints_lock:
+        if _hints is None:
+            _hints = RegionHints()
+            atexit.register(_hints.save)
+    return _hints
+
+
+def hint_stats():
+    return get_hints().stats()
+
+
+def region_hash(screen, region=None):
+    if region:
+        x, y, w, h = region
+        screen = screen[y:y + h, x:x + w]
+    if screen.size == 0:
+        return None
+    # 切片不連續時 tobytes() 會複製一份，整個畫面約 1 ms
+    return zlib.crc32(screen.tobytes())
+
+
+def _unchanged_miss(key, frame_hash):
+    """
+    搜尋範圍的像素與上一次未找到時完全相同，可直接判定未找到
+    """
+    with _fastpath_lock:
+        entry = _negative_hashes.get(key)
+        if entry is None or frame_hash is None or entry[0] != frame_hash:
+            return False
+        if entry[1] >= HASH_MAX_SKIPS:
+            entry[1] = 0
+            return False
+        entry[1] += 1
+        _skip_counts[key[0]] = _skip_counts.get(key[0], 0) + 1
+        return True
+
+
+def _remember_result(key, frame_hash, found):
+    with _fastpath_lock:
+        if found or frame_hash is None:
+            _negative_hashes.pop(key, None)
+        else:
+            entry = _negative_hashes.get(key)
+            skips = entry[1] if entry is not None else 0
+            _negative_hashes[key] = [frame_hash, skips]
+
+
+def skipped_matches(image_path=None):
+    """
+    雜湊快速檢查略過的比對次數；未指定模板時為全部模板的總數
+    """
+    with _fastpath_lock:
+        if image_path is None:
+            return sum(_skip_counts.values())
+        return _skip_counts.get(template_store.template_key(image_path), 0)
+
+
+def match_path(screen, image_path, region=None, threshold=MATCH_THRESHOLD, serial=None):
+    """
+    以模板路徑比對，回傳 Match
+    搜尋範圍的像素與上一次未找到時完全相同則直接回傳未找到；
+    未指定範圍時先搜尋模板上次出現的位置附近，找不到才搜尋全畫面
+    """
+    template = template_store.load_template(image_path)
+    if template is None:
+        logging.error(f"文件不存在: {image_path}")
+        return Match(image_path, False, -1.0, None, None)
+
+    if HASH_FASTPATH:
+        key = (template.path, tuple(region) if region else None, adb_device.resolve_serial(serial), threshold)
+        frame_hash = region_hash(screen, region)
+        if _unchanged_miss(key, frame_hash):
+            return Match(image_path, False, -1.0, None, template.shape)
+        match = _match_template(screen, template, image_path, region, threshold)
+        _remember_result(key, frame_hash, match.found)
+        return match
+    return _match_template(screen, template, image_path, region, threshold)
+
+
+def _match_template(screen, template, image_path, region, threshold):
+    """
+    位置提示 + 金字塔比對
+    """
+    hints = get_hints() if ROI_HINTS and not region else None
+    outcome = "scans"
+    if hints is not None:
+        hint_region = hints.region(template, screen.shape)
+        if hint_region is not None:
+            score, location = best_match(screen, template.image, hint_region)
+            if score >= threshold:
+                hints.record(template, "hits", location)
+                return Match(image_path, True, score, location, template.shape)
+            outcome = "misses"
+
+    score, location = find_template(screen, template, region, threshold)
+    found = score >= threshold
+    if hints is not None and (found or outcome == "scans"):
+        # 模板不在畫面上時提示沒有錯，只有全畫面搜尋找到 (位置已改變) 才算未命中
+        hints.record(template, outcome, location if found else None)
+    if found:
+        return Match(image_path, True, score, location, template.shape)
+    return Match(image_path, False, score, None, template.shape)
+
+
+def match_jobs(screen, jobs, threshold=MATCH_THRESHOLD, serial=None):
+    """
+    以同一幀平行比對多個 (模板路徑, 範圍) 工作，依提交順序回傳 Match
+    """
+    # 工作線程沒有綁定裝置，先在呼叫端取得 serial
+    serial = adb_device.resolve_serial(serial)
+    if len(jobs) <= 1:
+        return [match_path(screen, path, region, threshold, serial) for path, region in jobs]
+    executor = get_executor()
+    futures = [executor.submit(match_path, screen, path, region, threshold, serial) for path, region in jobs]
+    return [future.result() for future in futures]
+
+
+def match_all(screen, image_paths, region=None, threshold=MATCH_THRESHOLD, serial=None):
+    """
+    以同一幀比對多個模板，依輸入順序回傳每個模板的 Match
+    """
+    return match_jobs(screen, [(path, region) for path in image_paths], threshold, serial)
+
+
+def center_of(match):
+    return match.location[0] + match.shape[1] // 2, match.location[1] + match.shape[0] // 2
+
+
+def dhash(image, size=8):
+    """
+    差異雜湊 (dHash): 灰階縮成 (size+1)*size，比較左右相鄰像素，回傳 size*size 位元的整數
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def visible_run(matches):
+    """
+    從第一個找到的模板開始、連續找到的模板索引；全部未找到時為空列表
+    """
+    run = []
+    for index, match in enumerate(matches):
+        if match.found:
+            run.append(index)
+        elif run:
+            break
+    return run
+
+
+def verify_pyramid(frame_paths, image_paths=None, threshold=MATCH_THRESHOLD):
+    """
+    以錄下的畫面比較金字塔與全解析度的結果: 找到與否是否一致、位置誤差、耗時
+    """
+    store = template_store.get_store()
+    templates = [store.get(path) for path in image_paths] if image_paths else list(store._templates.values())
+    templates = [template for template in templates if template is not None]
+    agree = total = 0
+    max_offset = 0
+    full_time = pyramid_time = 0.0
+    for frame_path in frame_paths:
+        screen = cv2.imread(frame_path)
+        if screen is None:
+            print(f"無法讀取畫面: {frame_path}")
+            continue
+        for template in templates:
+            if template.shape[0] > screen.shape[0] or template.shape[1] > screen.shape[1]:
+                continue
+            start = time.perf_counter()
+            full_score, full_loc = best_match(screen, template.image)
+            full_time += time.perf_counter() - start
+            start = time.perf_counter()
+            score, loc = find_template(screen, template, threshold=threshold)
+            pyramid_time += time.perf_counter() - start
+            total += 1
+            full_found = full_score >= threshold
+            if full_found == (score >= threshold):
+                agree += 1
+            else:
+                print(f"結果不一致: {os.path.basename(template.path)} 於 {frame_path} "
+                      f"(全解析度 {full_score:.3f}，金字塔 {score:.3f})")
+            if full_found and loc is not None:
+                max_offset = max(max_offset, abs(loc[0] - full_loc[0]), abs(loc[1] - full_loc[1]))
+    if total:
+        print(f"一致 {agree}/{total}，最大位置誤差 {max_offset} px")
+        print(f"全解析度 {full_time / total * 1000:.2f} ms/次，金字塔 {pyramid_time / total * 1000:.2f} ms/次")
+    return agree, total
+
+
+def print_hint_stats():
+    stats = hint_stats()
+    if not stats:
+        print("尚無位置提示紀錄")
+        return
+    for key, (hits, misses, scans, rate) in sorted(stats.items()):
+        print(f"{key}: 命中 {hits}，未命中 {misses}，全畫面 {scans}，命中率 {rate:.0%}")
+
+
+def benchmark_parallel(image_path="screen.png", rounds=20, jobs=None):
+    """
+    比較逐一比對與線程池平行比對同一批工作的耗時
+    預設為 Star Rail 選單中 send.png 的三個候選範圍
+    """
+    global HASH_FASTPATH, ROI_HINTS
+    screen = cv2.imread(image_path)
+    if screen is None:
+        print(f"無法讀取圖片: {image_path}")
+        return
+    send = os.path.join(template_store.BASE_DIR, "photoForStar_Rail", "send.png")
+    jobs = jobs or [
+        (send, (1004, 335, 166, 98)),
+        (send, (1010, 430, 162, 104)),
+        (send, (1008, 534, 162, 92)),
+    ]
+    # 關閉雜湊快速檢查與位置提示，每次都實際執行比對
+    saved = HASH_FASTPATH, ROI_HINTS
+    HASH_FASTPATH = ROI_HINTS = False
+    try:
+        match_jobs(screen, jobs)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            serial_results = [match_path(screen, path, region) for path, region in jobs]
+        serial_time = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            parallel_results = match_jobs(screen, jobs)
+        parallel_time = (time.perf_counter() - start) / rounds
+    finally:
+        HASH_FASTPATH, ROI_HINTS = saved
+    assert [m.found for m in serial_results] == [m.found for m in parallel_results]
+    print(f"{len(jobs)} 個工作，線程池 {MATCH_WORKERS or os.cpu_count()} 個線程")
+    print(f"逐一比對: {serial_time * 1000:.2f} ms，平行比對: {parallel_time * 1000:.2f} ms，"
+          f"加速 {serial_time / parallel_time:.2f} 倍")
+    print("結果: " + ", ".join(f"{m.found} ({m.score:.3f})" for m in parallel_results))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench"]:
+        # python matcher.py bench [畫面.png]
+        benchmark_parallel(*sys.argv[2:3])
+    else:
+        verify_pyramid(sys.argv[1:] or ["screen.png"])
+        print_hint_stats()
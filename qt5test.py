@@ -1,15 +1,19 @@
 import sys
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
-import subprocess
 import time
 import logging
 import keyboard
 import cv2
-import numpy as np
-from functools import lru_cache
-import pytesseract
 import os
+import adb_capture
+import adb_client
+import adb_input
+import digit_ocr
+import matcher
+import template_store
+import waits
+import workflow
 
 # 初始化全局變量
 keep_running = True  # 控制程序運行狀態
@@ -110,66 +114,24 @@ class AutoScriptApp(QWidget):
 
         self.setup_adb()
 
-        self.find_and_click_image("./photoForStar_Rail/first.png")
         # choose = input("請輸入選擇: 1.飾品提取 2.擬造花萼(赤): ")
         if choose == "1":
             # choose_1 = input("請輸入選擇: 1.蠹役飢腸 2.永恆笑劇 3.伴你入眠 4.天劍如雨 5.孽果盤生 6.百年凍土 7.溫柔話語 8.浴火鋼心 9.堅城不倒: ")
-            if choose_1 == "1":
-                self.find_and_click_image("./photoForStar_Rail/send.png", region=(1004, 335, 166, 98))
-            elif choose_1 == "2":
-                self.find_and_click_image("./photoForStar_Rail/send.png", region=(1010, 430, 162, 104))
-            elif choose_1 == "3":
-                self.find_and_click_image("./photoForStar_Rail/send.png", region=(1008, 534, 162, 92))
-            else:
-                self.swipe(657, 583, 657, 308, 3100)
-                self.swipe(657, 583, 657, 308, 3100)
-                time.sleep(1)
-                if choose_1 == "4":
-                    self.find_and_click_image("./photoForStar_Rail/send.png", region=(1004, 335, 166, 98))
-                elif choose_1 == "5":
-                    self.find_and_click_image("./photoForStar_Rail/send.png", region=(1010, 430, 162, 104))
-                elif choose_1 == "6":
-                    self.find_and_click_image("./photoForStar_Rail/send.png", region=(1008, 534, 162, 92))
-                else:
-                    self.swipe(657, 583, 657, 300, 2800)
-                    time.sleep(1)
-                    if choose_1 == "7":
-                        self.find_and_click_image("./photoForStar_Rail/send.png", region=(1004, 335, 166, 98))
-                    elif choose_1 == "8":
-                        self.find_and_click_image("./photoForStar_Rail/send.png", region=(1010, 430, 162, 104))
-                    elif choose_1 == "9":
-                        self.find_and_click_image("./photoForStar_Rail/send.png", region=(1008, 534, 162, 92))
-            
-            if self.find_and_click_image("./photoForStar_Rail/startTo.png"):
-                time.sleep(3)
-                tee, _, _ = self.check_image("./photoForStar_Rail/universe.png")
-                if tee:
-                    logging.info("成功進入差分宇宙!")
-                else:
-                    self.click_until_next_image((704, 350), "./photoForStar_Rail/universe.png")
-                self.swipe(246, 561, 246, 422, duration=3000)
-                self.tap(1064, 552)
-                tee, _, _ = self.check_image("./photoForStar_Rail/exit.png")
-                if tee:
-                    logging.info("成功進入差分宇宙!")
-                else:
-                    self.click_until_next_image((1094, 334), "./photoForStar_Rail/exit.png")
-                # next = input("請輸入選擇: 1.繼續 2.退出: ")
-                # if next == "1":
-                #     self.find_and_click_image("./photoForStar_Rail/again.png")
-                # elif next == "2":
-                #     self.find_and_click_image("./photoForStar_Rail/exit.png")
-                
+            # 流程定義於 flows/star_universe.json (流程的第一步即點擊 first.png)
+            workflow.run_flow("star_universe", {"sub_choice": choose_1}, should_continue=lambda: keep_running)
+        else:
+            self.find_and_click_image("./photoForStar_Rail/first.png")
+
         logging.info("程序結束")
 
     def setup_adb(self):
-        """ 設置 ADB 連接 """
-        logging.info("啟動 ADB 服務器")
-        subprocess.run("adb start-server", shell=True)
+        """ 設置 ADB 連接，已建立的連接直接沿用 """
+        if adb_client.is_connected():
+            return
 
-        # 獲取已連接設備列表
-        devices = self.run_adb_command("devices")
-        if "device" not in devices:
+        logging.info("啟動 ADB 服務器")
+        # 確認設備已連接
+        if adb_client.connect() is None:
             logging.error("未檢測到已連接的設備，請確保模擬器已啟動並已連接。")
             sys.exit(1)
 
@@ -186,40 +148,32 @@ class AutoScriptApp(QWidget):
 
     def run_adb_command(self, command):
         """ 執行ADB命令 """
-        full_command = f"adb {command}"
         try:
-            result = subprocess.run(full_command, shell=True, capture_output=True, text=True)
-            if result.returncode != 0:
-                logging.error(f"ADB命令執行失敗: {full_command}，錯誤信息: {result.stderr}")
-            return result.stdout.strip()
+            return adb_client.run_adb_command(command)
         except Exception as e:
             logging.error(f"執行ADB命令出錯: {str(e)}")
             return None
 
     def tap(self, x, y):
         """ 在指定坐標點擊 """
-        self.run_adb_command(f"shell input tap {x} {y}")
+        adb_input.tap(x, y)
+        adb_capture.invalidate_frames()
         logging.info(f"點擊坐標: ({x}, {y})")
 
     def swipe(self, x1, y1, x2, y2, duration=500):
         """ 從一個坐標滑動到另一個坐標 """
-        self.run_adb_command(f"shell input swipe {x1} {y1} {x2} {y2} {duration}")
+        adb_input.swipe(x1, y1, x2, y2, duration)
+        adb_capture.invalidate_frames()
         logging.info(f"滑動從 ({x1}, {y1}) 到 ({x2}, {y2}) 持續 {duration} 毫秒")
-    @lru_cache(maxsize=10)
     def load_image(self, image_path):
         """
-        讀取並快取模板圖像
+        從模板圖庫讀取模板圖像 (所有模板在第一次使用時一併載入，並以磁碟快取加速)
         """
-        if not os.path.isfile(image_path):
-            logging.error(f"文件不存在: {image_path}")
-            return None
-        return cv2.imread(image_path)
+        return template_store.load_image(image_path)
 
     def capture_screen(self):
         try:
-            result = subprocess.run("adb exec-out screencap -p", shell=True, capture_output=True)
-            screen_np = np.frombuffer(result.stdout, np.uint8)
-            return cv2.imdecode(screen_np, cv2.IMREAD_COLOR)
+            return adb_capture.capture_screen()
         except Exception as e:
             logging.error(f"無法捕獲螢幕畫面: {str(e)}")
             return None
@@ -234,75 +188,102 @@ class AutoScriptApp(QWidget):
                 logging.error("無法捕獲螢幕畫面")
                 return False, None, None
 
-            if region:
-                x, y, w, h = region
-                screen = screen[y:y + h, x:x + w]
-
-            template = self.load_image(image_path)
-            if template is None:
-                return False, None, None
-
-            result = cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED)
-            _, max_val, _, max_loc = cv2.minMaxLoc(result)
-            
-            if max_val >= 0.8:
-                if region:
-                    max_loc = (max_loc[0] + x, max_loc[1] + y)
-                return True, max_loc, template.shape
+            # 模板匹配 (金字塔模式: 先縮小比對，再以全解析度精修)
+            match = matcher.match_path(screen, image_path, region)
+            if match.found:
+                return True, match.location, match.shape
             return False, None, None
         except Exception as e:
             logging.error(f"圖像處理過程中發生錯誤: {str(e)}")
             return False, None, None
 
-    def find_and_click_image(self, image_path, max_attempts=100, delay=0.1, region=None):
+    def find_and_click_image(self, image_path, max_attempts=100, delay=0.1, region=None, timeout=None):
         """
         找到屏幕上的圖像並點擊
+        畫面有變化時才重新比對，逾時 (預設為舊版 max_attempts 次嘗試約需的秒數) 後放棄
         """
-        for attempt in range(max_attempts):
-            if not keep_running:
-                logging.info("程序停止中...")
-                return False
-
-            found, location, shape = self.check_image(image_path, region)
-            if found:
-                center_x = location[0] + shape[1] // 2
-                center_y = location[1] + shape[0] // 2
-                self.tap(center_x, center_y)
-                logging.info(f"找到並點擊了圖像: {image_path} at {center_x}, {center_y}")
-                time.sleep(delay)
-                return True
-            else:
-                logging.info(f"未找到圖像，嘗試 {attempt + 1}/{max_attempts}，將重試...")
-                time.sleep(delay)
-        
-        logging.error(f"在 {max_attempts} 次嘗試後仍未找到匹配的圖像: {image_path}")
+        if not keep_running:
+            logging.info("程序停止中...")
+            return False
+
+        timeout = timeout or waits.attempts_timeout(max_attempts, delay)
+        match = waits.wait_for_image(image_path, region, timeout=timeout, should_continue=lambda: keep_running)
+        if match.found:
+            center_x, center_y = matcher.center_of(match)
+            self.tap(center_x, center_y)
+            logging.info(f"找到並點擊了圖像: {image_path} at {center_x}, {center_y}")
+            adb_input.sleep(delay)
+            return True
+
+        if not keep_running:
+            logging.info("程序停止中...")
+            return False
+        logging.error(f"在 {timeout} 秒內仍未找到匹配的圖像: {image_path}")
         return False
 
     def click_images_in_sequence(self, image_paths, max_attempts=50, delay=0.5, region=None):
         """
         依序點擊多張圖片
+        每次擷取以同一幀比對所有尚未點擊的圖片: 後面的圖片已出現時略過前面已通過的步驟，同時可見的連續步驟一次點完
         """
-        for i, image_path in enumerate(image_paths, 1):
+        pending = []
+        for image_path in image_paths:
+            if not os.path.isfile(image_path):
+                logging.error(f"文件不存在: {image_path}")
+                continue
+            pending.append(image_path)
+
+        step = 0
+        attempt = 0
+        while step < len(pending):
             if not keep_running:
                 logging.info("程序停止中...")
                 return False
 
-            if not os.path.isfile(image_path):
-                logging.error(f"文件不存在: {image_path}")
+            screen = self.capture_screen()
+            matches = matcher.match_all(screen, pending[step:], region) if screen is not None else []
+            clicks = matcher.visible_run(matches)
+            if not clicks:
+                attempt += 1
+                if attempt < max_attempts:
+                    logging.info(f"未找到第 {step + 1} 張圖片，嘗試 {attempt}/{max_attempts}，將重試...")
+                    time.sleep(delay)
+                    continue
+                logging.warning(f"無法點擊第 {step + 1} 張圖片: {pending[step]}，繼續下一張")
+                step += 1
+                attempt = 0
                 continue
-            
-            logging.info(f"正在嘗試點擊第 {i} 張圖片: {image_path}")
-            if self.find_and_click_image(image_path, max_attempts=max_attempts, delay=delay, region=region):
-                logging.info(f"成功點擊第 {i} 張圖片: {image_path}")
-            else:
-                logging.warning(f"無法點擊第 {i} 張圖片: {image_path}，繼續下一張")
-            time.sleep(delay)
+
+            if clicks[0] > 0:
+                logging.info(f"後面的圖片已出現，略過已通過的 {clicks[0]} 張圖片 (從第 {step + 1} 張起)")
+            for index in clicks:
+                center_x, center_y = matcher.center_of(matches[index])
+                self.tap(center_x, center_y)
+                logging.info(f"成功點擊第 {step + index + 1} 張圖片: {pending[step + index]} at {center_x}, {center_y}")
+                adb_input.sleep(delay * 2)
+            step += clicks[-1] + 1
+            attempt = 0
         return True
 
     def click_until_next_image(self, click_coords, next_image_path, max_attempts=50, delay=2, region=None):
         """
         持續點擊指定坐標，直到能夠檢測到下一張圖片
+        waits.PIPELINED_CLICK 開啟時點擊與擷取/比對同時進行，偵測到圖片後立即停止點擊
         """
+        if waits.PIPELINED_CLICK:
+            if not keep_running:
+                logging.info("程序停止中...")
+                return False
+            result = waits.tap_until_image(click_coords, next_image_path, region, timeout=max_attempts * delay,
+                                           tap_interval=delay, should_continue=lambda: keep_running)
+            if result.found:
+                logging.info(f"檢測到下一張圖片: {next_image_path} (耗時 {result.elapsed:.2f} 秒，點擊 {result.taps} 次)")
+            else:
+                logging.error(f"在 {result.elapsed:.0f} 秒內仍未檢測到下一張圖片。(點擊 {result.taps} 次)")
+            return result.found
+
+        start = time.monotonic()
+        skipped = matcher.skipped_matches(next_image_path)
         for attempt in range(max_attempts):
             if not keep_running:
                 logging.info("程序停止中...")
@@ -313,12 +294,12 @@ class AutoScriptApp(QWidget):
             
             found, _, _ = self.check_image(next_image_path, region)
             if found:
-                logging.info(f"檢測到下一張圖片: {next_image_path}")
+                logging.info(f"檢測到下一張圖片: {next_image_path} (耗時 {time.monotonic() - start:.2f} 秒，快速檢查略過 {matcher.skipped_matches(next_image_path) - skipped} 次比對)")
                 return True
             
             time.sleep(delay)
         
-        logging.error(f"在 {max_attempts} 次嘗試後仍未檢測到下一張圖片。")
+        logging.error(f"在 {max_attempts} 次嘗試後仍未檢測到下一張圖片。(快速檢查略過 {matcher.skipped_matches(next_image_path) - skipped} 次比對)")
         return False
 
     def click_and_print_coordinates(self):
@@ -354,9 +335,10 @@ class AutoScriptApp(QWidget):
         :param key: 按鍵的字符
         :param duration: 按下的持續時間（秒）
         """
-        self.run_adb_command(f"shell input text {key}")
+        adb_input.input_text(key)
+        adb_capture.invalidate_frames()
         logging.info(f"按下按鍵: {key} 持續時間: {duration} 秒")
-        time.sleep(duration)
+        adb_input.sleep(duration)
         # 釋放按鍵不需要額外的命令，因為 `input text` 命令會自動完成按下和釋放
 
     def calculate_region(self, points):
@@ -384,10 +366,10 @@ class AutoScriptApp(QWidget):
             x, y, w, h = region
             screen_region = screen[y:y + h, x:x + w]
 
-            # 使用 pytesseract 進行 OCR
-            text = pytesseract.image_to_string(screen_region, config='--psm 6 digits')
-            logging.info(f"檢測到的數字: {text.strip()}")
-            return text.strip()
+            # 以字形模板辨識數字，無法辨識時才使用 pytesseract
+            text = digit_ocr.read_number(screen_region)
+            logging.info(f"檢測到的數字: {text}")
+            return text
         except Exception as e:
             logging.error(f"OCR 過程中發生錯誤: {str(e)}")
             return None
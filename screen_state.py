@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import threading
+import logging
+import cv2
+import numpy as np
+import adb_capture
+import matcher
+import template_store
+
+"""
+    畫面狀態辨識
+    screen_states.json 列出每個已知畫面: 參考畫面 (screens/ 內錄下的截圖) 與數個錨點模板
+    classify() 以一次擷取同時比較所有畫面的簽章 (dHash + 縮圖) 與錨點，回傳最可能的畫面與信心分數
+"""
+INDEX_PATH = os.path.join(template_store.BASE_DIR, "screen_states.json")
+REFERENCE_DIR = "screens"  # 參考畫面資料夾 (相對於 BASE_DIR)
+THUMB_SIZE = (32, 18)  # 縮圖簽章大小 (16:9)
+MIN_CONFIDENCE = 0.6  # 低於此信心分數時視為未知畫面
+SIGNATURE_WEIGHT = 0.4  # 同時有參考畫面與錨點時，簽章佔的權重
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def signature(screen):
+    """
+    畫面簽章: (dHash, 正規化後的灰階縮圖)
+    """
+    gray = cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY) if screen.ndim == 3 else screen
+    thumb = cv2.resize(gray, THUMB_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+    thumb -= thumb.mean()
+    norm = np.linalg.norm(thumb)
+    if norm > 0:
+        thumb /= norm
+    return matcher.dhash(gray), thumb
+
+
+def signature_similarity(a, b):
+    """
+    兩個簽章的相似度 (0~1): dHash 相同位元比例與縮圖相關係數的平均
+    """
+    hash_similarity = 1.0 - matcher.hamming(a[0], b[0]) / 64.0
+    correlation = max(0.0, float(np.dot(a[1].ravel(), b[1].ravel())))
+    return (hash_similarity + correlation) / 2
+
+
+class ScreenState:
+    """
+    單一已知畫面
+    """
+    def __init__(self, name, group=None, reference=None, anchors=None):
+        self.name = name
+        self.group = group
+        self.reference = reference
+        self.anchors = anchors or []  # [(模板路徑, 範圍或 None)]
+        self.signature = None
+        if reference:
+            frame = cv2.imread(os.path.join(template_store.BASE_DIR, reference))
+            if frame is None:
+                logging.warning(f"無法讀取參考畫面: {reference}")
+            else:
+                self.signature = signature(frame)
+
+    @classmethod
+    def from_dict(cls, entry):
+        anchors = []
+        for anchor in entry.get("anchors", []):
+            if isinstance(anchor, str):
+                anchor = {"image": anchor}
+            region = tuple(anchor["region"]) if anchor.get("region") else None
+            anchors.append((os.path.join(template_store.BASE_DIR, anchor["image"]), region))
+        return cls(entry["name"], entry.get("group"), entry.get("reference"), anchors)
+
+
+class ScreenIndex:
+    """
+    已知畫面的索引
+    """
+    def __init__(self, states):
+        self.states = states
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or INDEX_PATH
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)["states"]
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"無法讀取畫面索引 {path}: {str(e)}")
+            entries = []
+        return cls([ScreenState.from_dict(entry) for entry in entries])
+
+    def scores(self, screen, group=None):
+        """
+        回傳 [(畫面名稱, 信心分數)]，由高到低排序
+        """
+        states = [state for state in self.states if group is None or state.group == group]
+        frame_signature = signature(screen)
+
+        # 所有錨點以同一幀一次平行比對 (同一模板與範圍只比對一次)
+        jobs = sorted({anchor for state in states for anchor in state.anchors}, key=str)
+        found = {job: match.found for job, match in zip(jobs, matcher.match_jobs(screen, jobs))}
+
+        results = []
+        for state in states:
+            parts = []
+            if state.signature is not None:
+                parts.append(signature_similarity(frame_signature, state.signature))
+            if state.anchors:
+                parts.append(sum(found[anchor] for anchor in state.anchors) / len(state.anchors))
+            if not parts:
+                continue
+            if len(parts) == 2:
+                confidence = SIGNATURE_WEIGHT * parts[0] + (1 - SIGNATURE_WEIGHT) * parts[1]
+            else:
+                confidence = parts[0]
+            results.append((state.name, confidence))
+        results.sort(key=lambda item: item[1], reverse=True)
+        return results
+
+    def classify(self, screen, group=None, min_confidence=None):
+        """
+        回傳 (最可能的畫面名稱, 信心分數)；信心不足時名稱為 None
+        """
+        min_confidence = MIN_CONFIDENCE if min_confidence is None else min_confidence
+        results = self.scores(screen, group)
+        if not results:
+            return None, 0.0
+        name, confidence = results[0]
+        if confidence < min_confidence:
+            return None, confidence
+        return name, confidence
+
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ScreenIndex.load()
+    return _index
+
+
+def classify(screen, group=None, min_confidence=None):
+    """
+    辨識目前畫面，回傳 (畫面名稱或 None, 信心分數)
+    """
+    if screen is None:
+        return None, 0.0
+    return get_index().classify(screen, group, min_confidence)
+
+
+def identify(group=None, serial=None):
+    """
+    擷取一次畫面並辨識
+    """
+    name, confidence = classify(adb_capture.capture_screen(serial), group)
+    logging.info(f"目前畫面: {name or '未知'} (信心 {confidence:.2f})")
+    return name, confidence
+
+
+def record_reference(name, serial=None, path=None):
+    """
+    將目前裝置畫面存為指定畫面的參考畫面，並更新 screen_states.json
+    """
+    global _index
+    path = path or INDEX_PATH
+    screen = adb_capture.capture_screen(serial)
+    if screen is None:
+        logging.error("無法捕獲螢幕畫面")
+        return False
+    reference = f"{REFERENCE_DIR}/{name}.png"
+    os.makedirs(os.path.join(template_store.BASE_DIR, REFERENCE_DIR), exist_ok=True)
+    cv2.imwrite(os.path.join(template_store.BASE_DIR, reference), screen)
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    for entry in data["states"]:
+        if entry["name"] == name:
+            entry["reference"] = reference
+            break
+    else:
+        data["states"].append({"name": name, "reference": reference, "anchors": []})
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    with _index_lock:
+        _index = None
+    logging.info(f"已記錄參考畫面: {name} -> {reference}")
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if len(sys.argv) >= 3 and sys.argv[1] == "record":
+        # python screen_state.py record <畫面名稱>
+        record_reference(sys.argv[2])
+    else:
+        # python screen_state.py [畫面.png ...]: 列出每張畫面的前三名
+        for frame_path in sys.argv[1:] or ["screen.png"]:
+            screen = cv2.imread(frame_path)
+            if screen is None:
+                print(f"無法讀取畫面: {frame_path}")
+                continue
+            ranking = ", ".join(f"{name} {score:.2f}" for name, score in get_index().scores(screen)[:3])
+            print(f"{frame_path}: {ranking}")
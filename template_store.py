@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import threading
+import logging
+import cv2
+import numpy as np
+
+"""
+    模板圖庫
+    啟動時一次載入 photo/ 與 photoForStar_Rail/ 內所有 PNG 模板，並預先算好灰階與縮小版本
+    結果以 .npy 存在 .template_cache/，之後以記憶體映射讀取，只有 PNG 的修改時間或大小改變時才重新解碼
+"""
+# 檢查是否在打包後運行
+if getattr(sys, 'frozen', False):
+    BASE_DIR = sys._MEIPASS
+    CACHE_DIR = os.path.join(os.path.dirname(sys.executable), ".template_cache")
+else:
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    CACHE_DIR = os.path.join(BASE_DIR, ".template_cache")
+
+TEMPLATE_DIRS = ["photo", "photoForStar_Rail"]
+SCALES = (2, 4)  # 預先產生 1/2 與 1/4 大小的版本
+CACHE_VERSION = 1
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def template_key(image_path):
+    return os.path.normcase(os.path.abspath(image_path))
+
+
+class Template:
+    """
+    單一模板及其預先計算的版本
+    """
+    def __init__(self, path, image, gray, scaled):
+        self.path = path
+        self.image = image  # BGR
+        self.gray = gray
+        self.scaled = scaled  # {縮小倍數: BGR}
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @classmethod
+    def from_image(cls, path, image):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        scaled = {}
+        for factor in SCALES:
+            size = (max(1, image.shape[1] // factor), max(1, image.shape[0] // factor))
+            scaled[factor] = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return cls(path, image, gray, scaled)
+
+    def variants(self):
+        variants = {"image": self.image, "gray": self.gray}
+        for factor, image in self.scaled.items():
+            variants[f"s{factor}"] = image
+        return variants
+
+
+class TemplateStore:
+    """
+    以路徑為鍵的模板快取，未預先載入的路徑在第一次使用時載入
+    """
+    def __init__(self, base_dir=BASE_DIR, template_dirs=TEMPLATE_DIRS, cache_dir=CACHE_DIR):
+        self.base_dir = base_dir
+        self.template_dirs = template_dirs
+        self.cache_dir = cache_dir
+        self.decoded = 0
+        self.from_cache = 0
+        self._templates = {}
+        self._index = self._read_index()
+        self._lock = threading.Lock()
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, "index.json")
+
+    def _read_index(self):
+        try:
+            with open(self._index_path(), encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version") == CACHE_VERSION:
+                return index
+        except (OSError, ValueError):
+            pass
+        return {"version": CACHE_VERSION, "templates": {}}
+
+    def _write_index(self):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._index_path(), "w", encoding="utf-8") as f:
+                json.dump(self._index, f, ensure_ascii=False, indent=1)
+        except OSError as e:
+            logging.warning(f"無法寫入模板快取索引: {str(e)}")
+
+    def _cache_name(self, key):
+        rel = os.path.relpath(key, self.base_dir) if key.startswith(os.path.normcase(self.base_dir)) else key
+        return "".join(c if c.isalnum() or c in "-_." else "_" for c in rel)
+
+    def _load_cached(self, key, stat):
+        entry = self._index["templates"].get(key)
+        if not entry or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            return None
+        name = entry["name"]
+        try:
+            variants = {
+                variant: np.load(os.path.join(self.cache_dir, f"{name}.{variant}.npy"), mmap_mode="r")
+                for variant in entry["variants"]
+            }
+        except (OSError, ValueError):
+            return None
+        scaled = {factor: variants[f"s{factor}"] for factor in SCALES if f"s{factor}" in variants}
+        return Template(key, variants["image"], variants["gray"], scaled)
+
+    def _save_cached(self, key, stat, template):
+        name = self._cache_name(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            variants = template.variants()
+            for variant, image in variants.items():
+                np.save(os.path.join(self.cache_dir, f"{name}.{variant}.npy"), np.ascontiguousarray(image))
+        except OSError as e:
+            logging.warning(f"無法寫入模板快取: {str(e)}")
+            return False
+        self._index["templates"][key] = {
+            "name": name,
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "variants": list(variants),
+        }
+        return True
+
+    def _load(self, key):
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return None, False
+        template = self._load_cached(key, stat)
+        if template is not None:
+            self.from_cache += 1
+            return template, False
+        image = cv2.imread(key)
+        if image is None:
+            logging.error(f"無法讀取模板圖像: {key}")
+            return None, False
+        self.decoded += 1
+        template = Template.from_image(key, image)
+        return template, self._save_cached(key, stat, template)
+
+    def preload(self):
+        """
+        載入所有模板資料夾中的 PNG
+        """
+        changed = False
+        with self._lock:
+            for folder in self.template_dirs:
+                folder = os.path.join(self.base_dir, folder)
+                if not os.path.isdir(folder):
+                    continue
+                for name in sorted(os.listdir(folder)):
+                    if not name.lower().endswith(".png"):
+                        continue
+                    key = template_key(os.path.join(folder, name))
+                    template, saved = self._load(key)
+                    if template is not None:
+                        self._templates[key] = template
+                    changed = changed or saved
+            if changed:
+                self._write_index()
+        logging.info(f"已載入 {len(self._templates)} 個模板 (快取 {self.from_cache}，解碼 {self.decoded})")
+
+    def get(self, image_path):
+        """
+        取得模板，檔案不存在或無法讀取時回傳 None
+        """
+        key = template_key(image_path)
+        template = self._templates.get(key)
+        if template is not None:
+            return template
+        with self._lock:
+            template, saved = self._load(key)
+            if template is None:
+                return None
+            self._templates[key] = template
+            if saved:
+                self._write_index()
+        return template
+
+
+def get_store():
+    """
+    取得全域模板圖庫，第一次呼叫時預先載入所有模板
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = TemplateStore()
+            _store.preload()
+    return _store
+
+
+def load_template(image_path):
+    return get_store().get(image_path)
+
+
+def load_image(image_path):
+    """
+    讀取模板圖像 (BGR)，檔案不存在時回傳 None
+    """
+    template = get_store().get(image_path)
+    if template is None:
+        logging.error(f"文件不存在: {image_path}")
+        return None
+    return template.image
@@ -0,0 +1,60 @@
+import unittest
+import adb_client
+from fake_adb_server import FakeAdbServer, FAKE_VERSION
+
+"""
+    adb_client 對假 adb server 的測試
+    執行: python -m unittest test_adb_client
+"""
+SERIAL = "emulator-5554"
+
+
+class AdbClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAdbServer(devices=[SERIAL], outputs={"echo hi": b"hi\n"}).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _client(self, serial=SERIAL, pool_size=0):
+        client = adb_client.AdbClient(port=self.server.port, serial=serial, pool_size=pool_size)
+        self.addCleanup(client.close)
+        return client
+
+    def test_version(self):
+        self.assertEqual(self._client().version(), FAKE_VERSION)
+
+    def test_devices(self):
+        self.assertEqual(self._client().devices(), [(SERIAL, "device")])
+
+    def test_shell_through_transport(self):
+        self.assertEqual(self._client().shell("echo hi"), "hi\n")
+        self.assertEqual(self.server.requests, [f"host:transport:{SERIAL}", "shell:echo hi"])
+
+    def test_transport_any(self):
+        self.assertEqual(self._client(serial=None).shell("echo hi"), "hi\n")
+        self.assertEqual(self.server.requests[0], "host:transport-any")
+
+    def test_pooled_socket_reused(self):
+        client = self._client(pool_size=1)
+        client._refill()  # 同步預先建立一條已切換到裝置的連線
+        self.assertEqual(self.server.connections, 1)
+        client.pool_size = 0  # 不再背景補充，讓連線數可預期
+        self.assertEqual(client.shell("echo hi"), "hi\n")
+        # 沒有新的連線，也沒有第二次 host:transport
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests, [f"host:transport:{SERIAL}", "shell:echo hi"])
+        self.assertEqual(client._pool, [])
+
+    def test_unknown_device_fails(self):
+        with self.assertRaises(adb_client.AdbError) as context:
+            self._client(serial="missing").shell("echo hi")
+        self.assertIn("device 'missing' not found", str(context.exception))
+
+    def test_unknown_host_command_fails(self):
+        with self.assertRaises(adb_client.AdbError):
+            self._client().host_command("host:bogus")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,237 @@
+import time
+import threading
+import logging
+from collections import namedtuple
+import cv2
+import numpy as np
+import adb_capture
+import adb_device
+import adb_input
+import matcher
+import template_store
+
+"""
+    等待圖像
+    依畫面變化驅動: 只有搜尋範圍的畫面有變化時才重新比對，畫面靜止 (例如讀取畫面) 時逐步拉長擷取間隔，
+    圖像一出現就回傳；以實際經過的秒數計算逾時，而不是嘗試次數
+    tap_until_image(): 點擊在輸入線程中依固定節奏送出，同時在呼叫端線程持續擷取與比對
+"""
+MIN_INTERVAL = 0.05  # 畫面有變化後下一次擷取的間隔 (秒)
+MAX_INTERVAL = 0.1  # 畫面靜止時擷取間隔的上限 (與舊版每 0.1 秒輪詢一次相同，出現後最多晚 0.1 秒發現)
+BACKOFF = 1.5  # 畫面沒有變化時間隔乘上的倍數
+CHANGE_CELL = 8  # 偵測畫面變化時，搜尋範圍縮成每格 CHANGE_CELL x CHANGE_CELL 像素的灰階縮圖
+CHANGE_THRESHOLD = 10  # 任一格的灰階平均值變動超過此值才算畫面有變化 (可濾掉串流壓縮雜訊)
+FORCE_MATCH_INTERVAL = 2.0  # 畫面一直沒有變化時，每隔幾秒仍強制比對一次
+PIPELINED_CLICK = True  # click_until_next_image 使用 tap_until_image (點擊與擷取同時進行)
+CAPTURE_INTERVAL = 0.05  # tap_until_image 兩次擷取之間的最短間隔
+LEGACY_CAPTURE_SECONDS = 0.4  # 舊版每次嘗試中 screencap + 解碼約需的秒數，用於把嘗試次數換算成逾時
+
+# tap_until_image 的結果: 是否找到、Match、偵測所需秒數、點擊次數、比對的畫面數
+TapResult = namedtuple("TapResult", ["found", "match", "elapsed", "taps", "frames"])
+
+
+def attempts_timeout(max_attempts, delay):
+    """
+    將舊版以嘗試次數表示的等待換算成秒數: 每次嘗試為一次 screencap 加上 delay
+    """
+    return max_attempts * (delay + LEGACY_CAPTURE_SECONDS)
+
+
+def change_thumbnail(frame, region=None):
+    """
+    搜尋範圍的灰階縮圖 (每格為 CHANGE_CELL 像素的平均)，用於判斷畫面是否有變化
+    整個畫面的 16x16 dHash 對小按鈕出現只會變動 1~2 位元，因此不用雜湊
+    """
+    if region:
+        x, y, w, h = region
+        frame = frame[y:y + h, x:x + w]
+    if frame.size == 0:
+        return None
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    height, width = gray.shape
+    size = (max(1, width // CHANGE_CELL), max(1, height // CHANGE_CELL))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+class FrameWatcher:
+    """
+    追蹤一台裝置一或多個範圍的畫面變化
+    """
+    def __init__(self, regions=(None,), serial=None):
+        self.regions = list(regions)
+        self.serial = adb_device.resolve_serial(serial)
+        self.interval = MIN_INTERVAL
+        self.captures = 0  # 擷取次數
+        self.frames = 0  # 回傳 (需要比對) 的畫面數
+        self._signature = None
+        self._last_change = 0.0
+
+    def signature(self, frame):
+        return tuple(change_thumbnail(frame, region) for region in self.regions)
+
+    def _changed(self, signature):
+        if self._signature is None:
+            return True
+        for old, new in zip(self._signature, signature):
+            if old is None or new is None or old.shape != new.shape:
+                return True
+            if np.abs(new - old).max() > CHANGE_THRESHOLD:
+                return True
+        return False
+
+    def next_frame(self, deadline, should_continue=None):
+        """
+        等待下一個有變化的畫面並回傳；逾時或被停止時回傳 None
+        """
+        should_continue = should_continue or adb_device.worker_running
+        while should_continue():
+            now = time.monotonic()
+            if now >= deadline:
+                return None
+            frame = adb_capture.capture_screen(self.serial)
+            self.captures += 1
+            if frame is not None:
+                signature = self.signature(frame)
+                changed = self._changed(signature)
+                if changed or now - self._last_change >= FORCE_MATCH_INTERVAL:
+                    if changed:
+                        self.interval = MIN_INTERVAL
+                    self._signature = signature
+                    self._last_change = now
+                    self.frames += 1
+                    return frame
+                # 畫面靜止，拉長下一次擷取的間隔
+                self.interval = min(self.interval * BACKOFF, MAX_INTERVAL)
+            time.sleep(max(0.0, min(self.interval, deadline - time.monotonic())))
+        return None
+
+    def reset(self):
+        """
+        點擊後畫面預期會改變，恢復最短間隔
+        """
+        self.interval = MIN_INTERVAL
+
+
+def wait_for_image(image_path, region=None, timeout=10, serial=None, should_continue=None):
+    """
+    等待圖像出現，回傳 matcher.Match；逾時、被停止或文件不存在時 found 為 False
+    """
+    if template_store.load_template(image_path) is None:
+        logging.error(f"文件不存在: {image_path}")
+        return matcher.Match(image_path, False, -1.0, None, None)
+    watcher = FrameWatcher([region], serial)
+    deadline = time.monotonic() + timeout
+    start = time.monotonic()
+    match = matcher.Match(image_path, False, -1.0, None, None)
+    while True:
+        frame = watcher.next_frame(deadline, should_continue)
+        if frame is None:
+            break
+        match = matcher.match_path(frame, image_path, region, serial=watcher.serial)
+        if match.found:
+            logging.info(f"{time.monotonic() - start:.2f} 秒後找到圖像: {image_path} "
+                         f"(擷取 {watcher.captures} 次，比對 {watcher.frames} 次)")
+            return match
+    logging.info(f"在 {timeout} 秒內未找到圖像: {image_path} (擷取 {watcher.captures} 次，比對 {watcher.frames} 次)")
+    return match
+
+
+def wait_any(targets, timeout=10, serial=None, should_continue=None):
+    """
+    同時等待多個可能的結果，回傳最先出現的 (名稱, matcher.Match)；逾時或被停止時回傳 (None, None)
+    targets: {名稱: 模板路徑 或 (模板路徑, 範圍)}；同一幀中有多個出現時，以 targets 中的順序優先
+    """
+    jobs = []
+    for name, target in targets.items():
+        image_path, region = target if isinstance(target, tuple) else (target, None)
+        if template_store.load_template(image_path) is None:
+            logging.error(f"文件不存在: {image_path}")
+            continue
+        jobs.append((name, image_path, region))
+    if not jobs:
+        return None, None
+
+    watcher = FrameWatcher(sorted({region for _, _, region in jobs}, key=str), serial)
+    deadline = time.monotonic() + timeout
+    start = time.monotonic()
+    while True:
+        frame = watcher.next_frame(deadline, should_continue)
+        if frame is None:
+            break
+        matches = matcher.match_jobs(frame, [(image_path, region) for _, image_path, region in jobs],
+                                     serial=watcher.serial)
+        for (name, image_path, _), match in zip(jobs, matches):
+            if match.found:
+                logging.info(f"{time.monotonic() - start:.2f} 秒後出現: {name} ({image_path}，"
+                             f"擷取 {watcher.captures} 次，比對 {watcher.frames} 次)")
+                return name, match
+    logging.info(f"在 {timeout} 秒內未出現: {', '.join(targets)} (擷取 {watcher.captures} 次，比對 {watcher.frames} 次)")
+    return None, None
+
+
+class TapWorker(threading.Thread):
+    """
+    依固定節奏點擊同一坐標，直到 stop()
+    """
+    def __init__(self, x, y, interval, serial=None):
+        super().__init__(name=f"tap-{serial}", daemon=True)
+        self.x = x
+        self.y = y
+        self.interval = interval
+        self.serial = serial
+        self.taps = 0
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        adb_device.use_device(self.serial)
+        while not self._stop_event.is_set():
+            adb_input.tap(self.x, self.y, self.serial)
+            adb_input.flush_input(self.serial)
+            adb_capture.invalidate_frames(self.serial)
+            self.taps += 1
+            # 偵測到圖像時 stop() 會立即喚醒，不會再多點一次
+            self._stop_event.wait(self.interval)
+
+
+def tap_until_image(click_coords, image_path, region=None, timeout=100, tap_interval=2, serial=None,
+                    should_continue=None):
+    """
+    持續點擊指定坐標直到圖像出現，回傳 TapResult
+    點擊在 TapWorker 中依 tap_interval 送出，呼叫端線程同時不斷擷取與比對，找到後立即停止點擊
+    """
+    serial = adb_device.resolve_serial(serial)
+    should_continue = should_continue or adb_device.worker_running
+    if template_store.load_template(image_path) is None:
+        logging.error(f"文件不存在: {image_path}")
+        return TapResult(False, None, 0.0, 0, 0)
+
+    worker = TapWorker(click_coords[0], click_coords[1], tap_interval, serial)
+    start = time.monotonic()
+    deadline = start + timeout
+    frames = 0
+    match = None
+    worker.start()
+    try:
+        while should_continue() and time.monotonic() < deadline:
+            frame_start = time.monotonic()
+            frame = adb_capture.capture_screen(serial)
+            if frame is not None:
+                frames += 1
+                match = matcher.match_path(frame, image_path, region, serial=serial)
+                if match.found:
+                    break
+            time.sleep(max(0.0, CAPTURE_INTERVAL - (time.monotonic() - frame_start)))
+    finally:
+        worker.stop()
+        worker.join()
+
+    elapsed = time.monotonic() - start
+    found = match is not None and match.found
+    if found:
+        logging.info(f"{elapsed:.2f} 秒後檢測到圖片: {image_path} (點擊 {worker.taps} 次，比對 {frames} 幀)")
+    else:
+        logging.info(f"{elapsed:.2f} 秒內未檢測到圖片: {image_path} (點擊 {worker.taps} 次，比對 {frames} 幀)")
+    return TapResult(found, match, elapsed, worker.taps, frames)
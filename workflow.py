@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import time
+import threading
+import logging
+import adb_capture
+import adb_device
+import adb_input
+import latency
+import matcher
+import screen_state
+import template_store
+import waits
+
+"""
+    流程引擎
+    周回流程以資料定義 (flows/*.json): 每個步驟有動作、參數、成功/失敗的下一步 (next / fallback)、
+    依結果分支的對應表 (on) 與逾時；流程在編譯時檢查所有轉移，並預先載入所有用到的模板與範圍
+    執行時每個步驟的耗時自動記錄，圖像相關步驟依上一個輸入動作以 latency 模型排程第一次擷取
+    run_concurrently() 讓多個流程各自在綁定裝置的線程中同時執行
+"""
+FLOW_DIR = os.path.join(template_store.BASE_DIR, "flows")
+END = "end"  # 流程成功結束
+FAIL = "fail"  # 流程失敗結束 (loop 流程會重新開始)
+CLICK_ATTEMPTS = 100  # click_image 未指定 timeout 時，與各腳本 find_and_click_image 相同的嘗試次數
+
+# 動作: 必要參數
+ACTIONS = {
+    "tap": ("coords",),
+    "swipe": ("coords",),
+    "sleep": ("seconds",),
+    "click_image": ("image",),
+    "click_sequence": ("images",),
+    "tap_until": ("coords", "image"),
+    "wait": ("targets",),
+    "branch": ("param",),
+}
+# 會改變畫面的動作，之後的圖像步驟以它作為延遲模型的起點
+INPUT_ACTIONS = {"tap", "swipe", "click_image", "click_sequence", "tap_until"}
+
+_flows = {}
+_flows_lock = threading.Lock()
+
+
+class FlowError(Exception):
+    """
+    流程定義錯誤 (編譯時發現)
+    """
+
+
+def _region(value, where):
+    if value is None:
+        return None
+    if not isinstance(value, (list, tuple)) or len(value) != 4 or not all(isinstance(v, int) for v in value):
+        raise FlowError(f"{where}: 範圍須為 [x, y, 寬, 高]")
+    return tuple(value)
+
+
+class Step:
+    """
+    編譯後的單一步驟
+    """
+    def __init__(self, name, action, args, next_step, fallback, on, after, settle):
+        self.name = name
+        self.action = action
+        self.args = args
+        self.next = next_step
+        self.fallback = fallback
+        self.on = on
+        self.after = after  # 成功後等待的秒數
+        self.settle = settle  # 延遲模型尚無紀錄時，圖像步驟開始前等待的秒數；tap_until 每次都固定等待
+
+    def targets(self):
+        """
+        wait 步驟的 {名稱: (模板路徑, 範圍)}
+        """
+        return self.args["targets"]
+
+    def images(self):
+        """
+        此步驟用到的 [(模板路徑, 範圍)]
+        """
+        region = self.args.get("region")
+        if self.action == "click_sequence":
+            return [(path, region) for path in self.args["images"]]
+        if self.action == "wait":
+            return list(self.targets().values())
+        if "image" in self.args:
+            return [(self.args["image"], region)]
+        return []
+
+
+class Flow:
+    """
+    編譯後的流程: 依名稱索引的步驟與起始步驟
+    """
+    def __init__(self, name, steps, start, loop=False, group=None, resume=None):
+        self.name = name
+        self.steps = steps
+        self.start = start
+        self.loop = loop  # 結束後重新開始，直到被停止
+        self.group = group  # screen_state 的畫面群組
+        self.resume = resume or {}  # {畫面名稱: 步驟名稱}，每一輪開始前辨識畫面決定起點
+
+    @classmethod
+    def compile(cls, data, name=None):
+        """
+        檢查流程定義並預先載入所有模板；定義有誤時拋出 FlowError
+        """
+        name = name or data.get("name", "flow")
+        entries = data.get("steps") or []
+        if not entries:
+            raise FlowError(f"{name}: 沒有任何步驟")
+
+        names = [entry.get("name") for entry in entries]
+        if None in names or len(set(names)) != len(names):
+            raise FlowError(f"{name}: 每個步驟都需要不重複的 name")
+
+        steps = {}
+        for index, entry in enumerate(entries):
+            step = _compile_step(entry, names[index + 1] if index + 1 < len(entries) else END, f"{name}.{entry['name']}")
+            steps[step.name] = step
+
+        valid = set(steps) | {END, FAIL}
+        for step in steps.values():
+            for target in [step.next, step.fallback] + list(step.on.values()):
+                if target not in valid:
+                    raise FlowError(f"{name}.{step.name}: 未知的下一步 {target}")
+        start = data.get("start", names[0])
+        resume = data.get("resume") or {}
+        for target in [start] + list(resume.values()):
+            if target not in valid:
+                raise FlowError(f"{name}: 未知的起始步驟 {target}")
+
+        flow = cls(name, steps, start, data.get("loop", False), data.get("group"), resume)
+        flow.preload()
+        return flow
+
+    def preload(self):
+        """
+        載入所有模板 (含縮小版本)，並確認模板放得進指定範圍
+        """
+        for step in self.steps.values():
+            for path, region in step.images():
+                template = template_store.load_template(path)
+                if template is None:
+                    raise FlowError(f"{self.name}.{step.name}: 文件不存在 {path}")
+                height, width = template.gray.shape[:2]
+                if region is not None and (width > region[2] or height > region[3]):
+                    raise FlowError(f"{self.name}.{step.name}: 模板 {path} ({width}x{height}) 大於範圍 {region}")
+
+    def images(self):
+        return sorted({path for step in self.steps.values() for path, _ in step.images()})
+
+
+def _image_path(value):
+    return os.path.join(template_store.BASE_DIR, value)
+
+
+def _compile_step(entry, default_next, where):
+    action = entry.get("action")
+    if action not in ACTIONS:
+        raise FlowError(f"{where}: 未知的動作 {action}")
+    for key in ACTIONS[action]:
+        if key not in entry:
+            raise FlowError(f"{where}: 缺少參數 {key}")
+
+    reserved = {"name", "action", "next", "fallback", "on", "after", "settle"}
+    args = {key: value for key, value in entry.items() if key not in reserved}
+    if "region" in args:
+        args["region"] = _region(args["region"], where)
+    if "image" in args:
+        args["image"] = _image_path(args["image"])
+    if "images" in args:
+        args["images"] = [_image_path(image) for image in args["images"]]
+    if "targets" in args:
+        targets = {}
+        for target_name, target in args["targets"].items():
+            if isinstance(target, str):
+                target = {"image": target}
+            targets[target_name] = (_image_path(target["image"]), _region(target.get("region"), where))
+        args["targets"] = targets
+
+    return Step(entry["name"], action, args, entry.get("next", default_next), entry.get("fallback", FAIL),
+                {str(key): value for key, value in (entry.get("on") or {}).items()},
+                entry.get("after", 0), entry.get("settle", 0.0))
+
+
+def load_flow(name):
+    """
+    讀取並編譯 flows/<name>.json (或指定的 JSON 路徑)，同一流程只編譯一次
+    """
+    path = name if name.endswith(".json") else os.path.join(FLOW_DIR, f"{name}.json")
+    with _flows_lock:
+        if path not in _flows:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            _flows[path] = Flow.compile(data, data.get("name", os.path.splitext(os.path.basename(path))[0]))
+        return _flows[path]
+
+
+class FlowRunner:
+    """
+    在一台裝置上執行一個流程，並統計每個步驟的耗時
+    """
+    def __init__(self, flow, params=None, serial=None, should_continue=None, log=None, before_iteration=None):
+        self.flow = flow
+        self.params = params or {}
+        self.serial = adb_device.resolve_serial(serial)
+        self._should_continue = should_continue
+        self.log = log or logging.info
+        self.before_iteration = before_iteration  # 每一輪開始前呼叫 (例如確認 adb 連線)
+        self.timings = {}  # {步驟名稱: [次數, 總秒數, 最長秒數]}
+        self.iterations = 0
+        self._since = None  # 上一個輸入動作完成的時間
+        self._last_action = None
+
+    def should_continue(self):
+        if self._should_continue is not None and not self._should_continue():
+            return False
+        return adb_device.worker_running()
+
+    def _action_key(self):
+        return f"{self.flow.name}.{self._last_action}"
+
+    def _resume_step(self):
+        if not self.flow.resume:
+            return self.flow.start
+        state, confidence = screen_state.classify(adb_capture.capture_screen(self.serial), self.flow.group)
+        if state in self.flow.resume:
+            self.log(f"[{self.flow.name}] 目前畫面: {state} (信心 {confidence:.2f})，從 {self.flow.resume[state]} 開始")
+            return self.flow.resume[state]
+        return self.flow.start
+
+    def run_once(self):
+        """
+        執行一輪流程，到達 end 時回傳 True；失敗或被停止時回傳 False
+        """
+        self._since = self._last_action = None
+        if self.before_iteration is not None:
+            self.before_iteration()
+        name = self._resume_step()
+        start = time.monotonic()
+        while name not in (END, FAIL):
+            if not self.should_continue():
+                self.log(f"[{self.flow.name}] 程序停止中...")
+                return False
+            step = self.flow.steps[name]
+            step_start = time.monotonic()
+            result = getattr(self, f"_{step.action}")(step)
+            if result and step.after:
+                adb_input.sleep(step.after, self.serial)
+            if result and step.action in INPUT_ACTIONS:
+                # 批次輸入時動作仍在佇列中，先送出再記錄時間，之後的等待才不會延後動作本身
+                adb_input.flush_input(self.serial)
+                self._since, self._last_action = time.monotonic(), step.name
+            elapsed = time.monotonic() - step_start
+
+            if isinstance(result, str) and result in step.on:
+                name = step.on[result]
+            else:
+                name = step.next if result else step.fallback
+            self._record(step.name, elapsed)
+            self.log(f"[{self.flow.name}] {step.name}: {elapsed:.2f} 秒 -> {name}")
+        self.iterations += 1
+        self.log(f"[{self.flow.name}] 第 {self.iterations} 輪{'完成' if name == END else '失敗'}，耗時 {time.monotonic() - start:.2f} 秒")
+        return name == END
+
+    def run(self):
+        """
+        執行流程；loop 流程持續重新開始直到被停止。結束時列出每個步驟的耗時統計
+        """
+        try:
+            if not self.flow.loop:
+                return self.run_once()
+            while self.should_continue():
+                self.run_once()
+            return True
+        finally:
+            self.print_summary()
+
+    def _record(self, name, elapsed):
+        timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+
+    def summary(self):
+        """
+        {步驟名稱: (次數, 平均秒數, 最長秒數)}
+        """
+        return {name: (count, total / count, longest) for name, (count, total, longest) in self.timings.items()}
+
+    def print_summary(self):
+        for name, (count, average, longest) in self.summary().items():
+            self.log(f"[{self.flow.name}] {name}: {count} 次，平均 {average:.2f} 秒，最長 {longest:.2f} 秒")
+
+    # 動作
+
+    def _tap(self, step):
+        x, y = step.args["coords"]
+        adb_input.tap(x, y, self.serial)
+        adb_capture.invalidate_frames(self.serial)
+        return True
+
+    def _swipe(self, step):
+        x1, y1, x2, y2 = step.args["coords"]
+        adb_input.swipe(x1, y1, x2, y2, step.args.get("duration", 500), self.serial)
+        adb_capture.invalidate_frames(self.serial)
+        return True
+
+    def _sleep(self, step):
+        adb_input.sleep(step.args["seconds"], self.serial)
+        return True
+
+    def _branch(self, step):
+        # 參數值由 on 對應到下一步；沒有對應時走 next
+        value = str(self.params.get(step.args["param"], ""))
+        return value if value in step.on else True
+
+    def _click_image(self, step):
+        image_path = step.args["image"]
+        delay = step.args.get("delay", 0.1)
+        timeout = step.args.get("timeout") or waits.attempts_timeout(CLICK_ATTEMPTS, delay)
+        match = latency.wait_for_image(self._action_key(), image_path, step.args.get("region"), timeout,
+                                       self._since, step.settle, self.serial, self.should_continue)
+        if not match.found:
+            return False
+        center_x, center_y = matcher.center_of(match)
+        adb_input.tap(center_x, center_y, self.serial)
+        adb_capture.invalidate_frames(self.serial)
+        adb_input.sleep(delay, self.serial)
+        return True
+
+    def _click_sequence(self, step):
+        """
+        與各腳本的 click_images_in_sequence 相同: 同一幀比對所有剩下的圖片，可見的連續步驟一次點完
+        """
+        pending = step.args["images"]
+        region = step.args.get("region")
+        max_attempts = step.args.get("max_attempts", 50)
+        delay = step.args.get("delay", 0.5)
+        index = attempt = 0
+        while index < len(pending):
+            if not self.should_continue():
+                return False
+            screen = adb_capture.capture_screen(self.serial)
+            matches = matcher.match_all(screen, pending[index:], region, serial=self.serial) if screen is not None else []
+            clicks = matcher.visible_run(matches)
+            if not clicks:
+                attempt += 1
+                if attempt < max_attempts:
+                    time.sleep(delay)
+                    continue
+                self.log(f"[{self.flow.name}] 無法點擊第 {index + 1} 張圖片: {pending[index]}，繼續下一張")
+                index += 1
+                attempt = 0
+                continue
+            for offset in clicks:
+                center_x, center_y = matcher.center_of(matches[offset])
+                adb_input.tap(center_x, center_y, self.serial)
+                adb_capture.invalidate_frames(self.serial)
+                adb_input.sleep(delay * 2, self.serial)
+            index += clicks[-1] + 1
+            attempt = 0
+        return True
+
+    def _tap_until(self, step):
+        image_path = step.args["image"]
+        if step.settle:
+            adb_input.sleep(step.settle, self.serial)
+        # 不依 p50 延後第一次點擊: 點擊本身就是轉場的原因，預先等待會被算進樣本而使 p50 不斷變大
+        # 樣本改從開始點擊時計時
+        since = latency.mark_sent(serial=self.serial) if self._since is not None else None
+        result = waits.tap_until_image(step.args["coords"], image_path, step.args.get("region"),
+                                       step.args.get("timeout", 100), step.args.get("interval", 2), self.serial,
+                                       self.should_continue)
+        if result.found and since is not None:
+            latency.observe(self._action_key(), image_path, since)
+        return result.found
+
+    def _wait(self, step):
+        targets = step.targets()
+        name, _ = latency.wait_any(self._action_key(), targets, step.args.get("timeout", 10), self._since,
+                                   step.settle, self.serial, self.should_continue)
+        return name
+
+
+def run_flow(name, params=None, serial=None, should_continue=None, log=None, before_iteration=None):
+    """
+    在目前線程 (或指定裝置) 執行流程，回傳 FlowRunner.run() 的結果
+    """
+    return FlowRunner(load_flow(name), params, serial, should_continue, log, before_iteration).run()
+
+
+def run_concurrently(jobs):
+    """
+    同時執行多個流程，jobs: [(流程名稱, 裝置 serial, 參數)]
+    每個流程在各自綁定裝置的 fleet.DeviceWorker 線程中執行；回傳所有 worker 供呼叫端停止或等待
+    """
+    # fleet 匯入 Ld_noUI，而 Ld_noUI 匯入本模組，因此在這裡才匯入
+    import fleet
+
+    # 先在主線程編譯，定義有誤時在啟動任何線程前就發現
+    flows = [(load_flow(name), serial, params) for name, serial, params in jobs]
+    workers = []
+    for flow, serial, params in flows:
+        runner = FlowRunner(flow, params, serial)
+        worker = fleet.DeviceWorker(serial, runner.run)
+        worker.name = f"{flow.name}-{serial}"
+        workers.append(worker)
+        worker.start()
+    return workers
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(threadName)s - %(levelname)s - %(message)s")
+    if len(sys.argv) >= 2:
+        # python workflow.py <流程名稱> [serial ...]: 在指定裝置 (預設全部已連接的裝置) 上同時執行
+        import adb_client
+        adb_client.start_server()
+        serials = sys.argv[2:] or adb_client.list_devices()
+        workers = run_concurrently([(sys.argv[1], serial, None) for serial in serials])
+        for worker in workers:
+            worker.join()
+    else:
+        # python workflow.py: 編譯 flows/ 內所有流程並列出步驟數與模板數
+        for file_name in sorted(os.listdir(FLOW_DIR)):
+            if file_name.endswith(".json"):
+                try:
+                    flow = load_flow(os.path.join(FLOW_DIR, file_name))
+                    print(f"{flow.name}: {len(flow.steps)} 個步驟，{len(flow.images())} 張模板")
+                except (OSError, ValueError, FlowError) as e:
+                    print(f"{file_name}: {str(e)}")